@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# Description: Speed and accuracy of the reduced-sample-rate log-mel front end.
+'''
+    Runs logmel_frontend.LogMelFrontEnd at the full rate and with
+    resample_sr set to each of the given rates, over the wav files of a fold
+    list (or synthetic stereo clips), and writes the time per clip and the
+    log-mel error against the full-rate pipeline as JSON:
+        python benchmark_frontend.py --rates 32000,24000,16000 \
+            --setup_file ../data/dcase2019/Task1a/dev/evaluation_setup/fold1_evaluate.csv
+    The error of a reduced rate is measured against the full-rate front end
+    with the same capped fmax, i.e. on the same mel bands.
+'''
+import argparse
+import itertools
+import json
+import os
+import socket
+import sys
+import time
+import numpy as np
+import pandas as pd
+import soundfile as sound
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, 'utils'))
+
+import logmel_frontend
+
+
+def synthetic_clips(num_clips, sr, duration, seed=0):
+    """Stereo clips of pink-ish noise plus a few tones, like scene recordings."""
+    rng = np.random.RandomState(seed)
+    num_samples = int(sr * duration)
+    t = np.arange(num_samples) / float(sr)
+    clips = []
+    for _ in range(num_clips):
+        noise = np.cumsum(rng.normal(0, 1, (num_samples, 2)), 0)
+        noise -= noise.mean(0)
+        s = 0.01 * noise / np.abs(noise).max()
+        for f in rng.uniform(50, sr / 2 * 0.9, 8):
+            s += rng.uniform(0.01, 0.1) * np.sin(2 * np.pi * f * t)[:, None]
+        clips.append(s.astype(np.float32))
+    return clips
+
+
+def load_clips(setup_file, num_clips, sr):
+    data_list = pd.read_csv(setup_file, sep='\t', encoding='ASCII')
+    wav_root = os.path.dirname(os.path.dirname(os.path.abspath(setup_file)))
+    clips = []
+    for wav_path in data_list['filename'][:num_clips]:
+        s, fs = sound.read(os.path.join(wav_root, wav_path), dtype='float32')
+        if fs != sr:
+            raise ValueError('%s is sampled at %d Hz, expected %d' % (wav_path, fs, sr))
+        clips.append(s)
+    return clips
+
+
+def run(frontend, clips, num_frames, repeats):
+    """Log-mels of the clips and the best of repeats mean time per clip."""
+    feats = [frontend.stereo_log_mel(s, num_frames) for s in clips]
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        for s in clips:
+            frontend.stereo_log_mel(s, num_frames)
+        times.append((time.time() - start) / len(clips))
+    return feats, min(times)
+
+
+def compare(feats, ref_feats, top_bands=8):
+    """Log-mel errors, over all bands and over the top bands next to the new Nyquist."""
+    feats, ref_feats = np.stack(feats), np.stack(ref_feats)
+    err = np.abs(feats - ref_feats)
+    return {'mean_abs_error': float(err.mean()),
+            'p99_abs_error': float(np.percentile(err, 99)),
+            'max_abs_error': float(err.max()),
+            'mean_abs_error_low_bands': float(err[:, :-top_bands].mean()),
+            'mean_abs_error_top_bands': float(err[:, -top_bands:].mean()),
+            'correlation': float(np.corrcoef(feats.ravel(), ref_feats.ravel())[0, 1])}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--setup_file', default=None, help='Fold list whose wav files are used instead of synthetic clips [default: None]')
+    parser.add_argument('--num_clips', type=int, default=8, help='Clips processed per configuration [default: 8]')
+    parser.add_argument('--rates', default='32000,24000,16000', help='Reduced analysis sample rates [default: 32000,24000,16000]')
+    parser.add_argument('--filter_half_lens', default='10,4', help='Anti-aliasing filter half lengths, see LogMelFrontEnd [default: 10,4]')
+    parser.add_argument('--sr', type=int, default=48000, help='Sample rate of the clips [default: 48000]')
+    parser.add_argument('--duration', type=float, default=10, help='Duration of the synthetic clips in seconds [default: 10]')
+    parser.add_argument('--n_fft', type=int, default=2048, help='FFT size at sr [default: 2048]')
+    parser.add_argument('--hop_length', type=int, default=1024, help='Hop at sr [default: 1024]')
+    parser.add_argument('--n_mels', type=int, default=128, help='Number of mel bands [default: 128]')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed passes, the fastest is kept [default: 3]')
+    parser.add_argument('--output', default='frontend_bench.json', help='Result file [default: frontend_bench.json]')
+    FLAGS = parser.parse_args()
+
+    if FLAGS.setup_file is not None:
+        clips = load_clips(FLAGS.setup_file, FLAGS.num_clips, FLAGS.sr)
+    else:
+        clips = synthetic_clips(FLAGS.num_clips, FLAGS.sr, FLAGS.duration)
+    num_frames = int(np.ceil(float(len(clips[0])) / FLAGS.hop_length))
+
+    full = logmel_frontend.LogMelFrontEnd(FLAGS.sr, FLAGS.n_fft, FLAGS.hop_length, FLAGS.n_mels)
+    _, full_time = run(full, clips, num_frames, FLAGS.repeats)
+    runs = [{'resample_sr': None, 'n_fft': full.n_fft, 'hop_length': full.hop_length,
+             'fmax': full.fmax, 'ms_per_clip': full_time * 1000.0, 'speedup': 1.0}]
+    print(json.dumps(runs[0]))
+    for rate, half_len in itertools.product([int(r) for r in FLAGS.rates.split(',')],
+                                            [int(h) for h in FLAGS.filter_half_lens.split(',')]):
+        reduced = logmel_frontend.LogMelFrontEnd(FLAGS.sr, FLAGS.n_fft, FLAGS.hop_length,
+                                                 FLAGS.n_mels, resample_sr=rate,
+                                                 filter_half_len=half_len)
+        # full-rate reference on the same mel bands
+        ref = logmel_frontend.LogMelFrontEnd(FLAGS.sr, FLAGS.n_fft, FLAGS.hop_length,
+                                             FLAGS.n_mels, fmax=reduced.fmax)
+        feats, reduced_time = run(reduced, clips, num_frames, FLAGS.repeats)
+        ref_feats, _ = run(ref, clips, num_frames, 1)
+        result = {'resample_sr': rate, 'filter_half_len': half_len, 'n_fft': reduced.n_fft,
+                  'hop_length': reduced.frame_hop, 'fmax': reduced.fmax,
+                  'ms_per_clip': reduced_time * 1000.0,
+                  'speedup': full_time / reduced_time}
+        result.update(compare(feats, ref_feats))
+        print(json.dumps(result))
+        runs.append(result)
+
+    with open(FLAGS.output, 'w') as f:
+        json.dump({'host': socket.gethostname(), 'cpu_count': os.cpu_count(),
+                   'args': vars(FLAGS), 'num_frames': num_frames, 'runs': runs}, f, indent=2)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+# Description: Throughput benchmark of dataloader.get_loader.
+'''
+    Sweeps loader type, number of workers, batch size and storage format over
+    synthetic feature stores (or an existing data dir) and writes the results
+    as JSON:
+        python benchmark_loader.py --workers 0,4,8 --batch_sizes 32,64 \
+            --dtypes float32,uint8 --output loader_bench.json
+'''
+import argparse
+import itertools
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import numpy as np
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, 'utils'))
+sys.path.append(os.path.join(BASE_DIR, 'utils', 'dataloader_utils'))
+
+import dataloader
+import feature_store
+import spec_transforms
+import target_transforms
+
+
+def make_store(root, num_clips, dtype, num_bins=128, num_frames=469,
+               num_channels=3, num_classes=10, seed=0):
+    """
+    Writes a synthetic root/seq_diff_train store of num_clips log-mel like
+    clips in the given storage dtype, with its labels and statistics.
+    """
+    store_path = os.path.join(root, 'seq_diff_train')
+    rng = np.random.RandomState(seed)
+    writer = feature_store.FeatureWriter(store_path, 'X_train', num_clips,
+                                         (num_bins, num_frames, num_channels), dtype)
+    stats = feature_store.RunningStats(num_channels)
+    for i in range(num_clips):
+        feat = rng.normal(-5.0, 3.0, (num_bins, num_frames, num_channels)).astype(np.float32)
+        writer[i] = feat
+        stats.update(feat)
+    writer.flush()
+    stats.save(store_path)
+    feature_store.save_array(store_path, 'y_train', rng.randint(0, num_classes, num_clips))
+    feature_store.save_array(store_path, 'audio_ids',
+                             np.array(['clip%06d' % i for i in range(num_clips)]))
+    feature_store.save_array(store_path, 'class_names',
+                             np.array(['class%d' % i for i in range(num_classes)]))
+    return store_path
+
+
+def read_rss(pid):
+    """(VmRSS, RssAnon) of a process in MB, RssAnon excludes the page cache of the store."""
+    rss = {}
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            key = line.split(':')[0]
+            if key in ('VmRSS', 'RssAnon'):
+                rss[key] = int(line.split()[1]) / 1024.0
+    return rss.get('VmRSS', 0.0), rss.get('RssAnon', 0.0)
+
+
+def child_pids(pid):
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                stat = f.read()
+        except IOError:
+            continue
+        # the ppid follows the parenthesized command name
+        if int(stat[stat.rindex(')') + 2:].split()[1]) == pid:
+            pids.append(int(entry))
+    return pids
+
+
+def prefetch_depth(loader):
+    """Batches a loader can have ready before they are asked for."""
+    if loader.num_workers == 0:
+        return 0
+    if hasattr(loader, 'num_slots'):
+        return loader.num_slots
+    return loader.num_workers * loader.prefetch
+
+
+def benchmark(root, loader, num_workers, batch_size, num_batches, num_segs, seg_length):
+    normalize = spec_transforms.ToNormalizedTensor(feature_store.find_stats(root))
+    transform = spec_transforms.Compose([normalize])
+
+    def get_loader(train_repeat):
+        return dataloader.get_loader(root=root,
+                                     train_transform=transform,
+                                     val_transform=transform,
+                                     target_transform=target_transforms.ClassLabel(),
+                                     batch_size=batch_size,
+                                     num_segs=num_segs,
+                                     n_threads=num_workers,
+                                     train_repeat=train_repeat,
+                                     training=True, val=False, test=False,
+                                     seg_length=seg_length,
+                                     channels_last=True,
+                                     shared_memory=loader == 'shm')[0]
+
+    train_loader = get_loader(1)
+    # the first batches may have been prefetched while the loader started,
+    # the steady state is timed on num_batches batches past them
+    warmup = prefetch_depth(train_loader)
+    total_batches = warmup + num_batches
+    if len(train_loader) < total_batches:
+        # passes enough for the warm-up and the timed batches on small stores
+        train_loader = get_loader(total_batches / float(len(train_loader)))
+    total_batches = min(total_batches, len(train_loader))
+    start = time.time()
+    arrivals = []
+    rss = None
+    batches = iter(train_loader)
+    for i, (inputs, targets) in enumerate(batches):
+        arrivals.append(time.time())
+        if i == warmup + num_batches // 2:
+            workers = [read_rss(pid) for pid in child_pids(os.getpid())]
+            rss = {'main': read_rss(os.getpid()), 'workers': workers}
+        if i + 1 == total_batches:
+            break
+    # stop the workers before the next run
+    del batches
+    if getattr(train_loader, 'shutdown', None):
+        train_loader.shutdown()
+    first_batch = arrivals[0] - start
+    timed = arrivals[warmup:]
+    latencies = np.diff(timed) * 1000.0
+    steady = timed[-1] - timed[0] if len(timed) > 1 else 0
+    result = {'time_to_first_batch_s': first_batch,
+              'num_batches': len(arrivals),
+              'warmup_batches': warmup,
+              'samples_per_s': (len(timed) - 1) * batch_size / steady if steady > 0 else None,
+              'samples_per_s_incl_first': len(arrivals) * batch_size / (arrivals[-1] - start)}
+    if len(latencies):
+        for p in [50, 90, 99]:
+            result['latency_p%d_ms' % p] = float(np.percentile(latencies, p))
+    if rss is not None:
+        result['rss_main_mb'], result['rss_anon_main_mb'] = rss['main']
+        if rss['workers']:
+            result['rss_worker_mb'] = float(np.mean([r[0] for r in rss['workers']]))
+            result['rss_anon_worker_mb'] = float(np.mean([r[1] for r in rss['workers']]))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', default=None, help='Existing data dir to read instead of synthetic stores [default: None]')
+    parser.add_argument('--tmp_dir', default=None, help='Where to write the synthetic stores [default: system temp dir]')
+    parser.add_argument('--num_clips', type=int, default=256, help='Clips per synthetic store [default: 256]')
+    parser.add_argument('--dtypes', default='float32,float16,uint8', help='Storage formats of the synthetic stores [default: float32,float16,uint8]')
+    parser.add_argument('--loaders', default='native,shm', help='native_loader.BatchLoader and/or shared-memory loader [default: native,shm]')
+    parser.add_argument('--workers', default='0,2,4,8', help='Numbers of loader workers [default: 0,2,4,8]')
+    parser.add_argument('--batch_sizes', default='32', help='Batch sizes [default: 32]')
+    parser.add_argument('--num_batches', type=int, default=50, help='Batches timed per run, after the batches prefetched by the workers [default: 50]')
+    parser.add_argument('--num_segs', type=int, default=8, help='Segments per clip [default: 8]')
+    parser.add_argument('--seg_length', type=int, default=80, help='Frames per segment [default: 80]')
+    parser.add_argument('--output', default='loader_bench.json', help='Result file [default: loader_bench.json]')
+    FLAGS = parser.parse_args()
+
+    if FLAGS.data is not None:
+        stores = {'data': FLAGS.data}
+        tmp_dir = None
+    else:
+        tmp_dir = tempfile.mkdtemp(dir=FLAGS.tmp_dir)
+        stores = {}
+        for dtype in FLAGS.dtypes.split(','):
+            stores[dtype] = os.path.join(tmp_dir, dtype)
+            make_store(stores[dtype], FLAGS.num_clips, dtype)
+
+    runs = []
+    try:
+        for (name, root), loader, num_workers, batch_size in itertools.product(
+                sorted(stores.items()), FLAGS.loaders.split(','),
+                [int(w) for w in FLAGS.workers.split(',')],
+                [int(b) for b in FLAGS.batch_sizes.split(',')]):
+            if loader == 'shm' and num_workers == 0:
+                # the shared-memory loader always forks at least one worker
+                print('Skipping shm with 0 workers')
+                continue
+            run = {'store': name, 'loader': loader, 'num_workers': num_workers,
+                   'batch_size': batch_size}
+            run.update(benchmark(root, loader, num_workers, batch_size,
+                                 FLAGS.num_batches, FLAGS.num_segs, FLAGS.seg_length))
+            print(json.dumps(run))
+            runs.append(run)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    with open(FLAGS.output, 'w') as f:
+        json.dump({'host': socket.gethostname(), 'cpu_count': os.cpu_count(),
+                   'args': vars(FLAGS), 'runs': runs}, f, indent=2)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# Description: Storage benchmark of the compressed feature shards.
+'''
+    Writes the training store as uncompressed shards and as shards
+    compressed with each available codec (see utils/shard_store.py), then
+    compares them with the memory-mapped float32 store on stored bytes per
+    clip, decompression cost, bytes read and end-to-end loader samples/s and
+    CPU time:
+        python benchmark_shards.py --data ../data/dcase2019/Task1a/dev \
+            --codecs zlib,lz4,zstd --workers 0,4 --output shard_bench.json
+    The synthetic stores used without --data are Gaussian noise, which does
+    not compress like log-mels: pass --data for meaningful ratios.
+    The bytes read are taken from /proc/<pid>/io of the processes that read
+    the store, the loader workers (or this process without workers): rchar,
+    the bytes of read calls, page cache hits included, which misses the
+    page faults of the memory-mapped npy store, and read_bytes, the bytes
+    fetched from storage, which only means something on cold reads.
+    read_amplification is rchar over the stored bytes of the clips loaded,
+    about 1 when every shard is read by one worker only. --drop_caches
+    (root only) drops the page cache before every loader run, to time cold
+    reads.
+'''
+import argparse
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import numpy as np
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BASE_DIR, 'utils'))
+sys.path.append(os.path.join(BASE_DIR, 'utils', 'dataloader_utils'))
+
+import dataloader
+import feature_store
+import shard_store
+import spec_transforms
+import target_transforms
+from benchmark_loader import make_store
+
+STORE = 'seq_diff_train'
+
+
+def stored_bytes(path):
+    """Size of a feature array, a .npy file or a folder of shards."""
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)
+                   if f != shard_store.INDEX_FILE)
+    return os.path.getsize(path + '.npy')
+
+
+def cpu_time():
+    """CPU seconds of this process and of its reaped children."""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def read_io(pid='self'):
+    """(rchar, read_bytes) counters of a process, see proc(5)."""
+    counters = {}
+    with open('/proc/%s/io' % pid) as f:
+        for line in f:
+            name, value = line.split(':')
+            counters[name] = int(value)
+    return counters['rchar'], counters['read_bytes']
+
+
+def drop_caches():
+    try:
+        os.system('sync')
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+    except (IOError, OSError):
+        print('Cannot drop the page cache, the reads may be warm')
+
+
+def decode_cost(feats):
+    """Wall and CPU seconds to read every clip once, from the page cache."""
+    start, start_cpu = time.time(), cpu_time()
+    if isinstance(feats, shard_store.ShardedFeatures):
+        for shard in range(len(feats.shards)):
+            feats.read_shard(shard)
+    else:
+        for i in range(len(feats)):
+            np.array(feats[i])
+    return time.time() - start, cpu_time() - start_cpu
+
+
+def benchmark(root, sharded, num_workers, batch_size, num_batches, window_shards,
+              num_segs, seg_length, train_repeat=1):
+    normalize = spec_transforms.ToNormalizedTensor(feature_store.find_stats(root, sharded=sharded))
+    transform = spec_transforms.Compose([normalize])
+    train_loader, _ = dataloader.get_loader(root=root,
+                                            train_transform=transform,
+                                            val_transform=transform,
+                                            target_transform=target_transforms.ClassLabel(),
+                                            batch_size=batch_size,
+                                            num_segs=num_segs,
+                                            n_threads=num_workers,
+                                            train_repeat=train_repeat,
+                                            training=True, val=False, test=False,
+                                            seg_length=seg_length,
+                                            channels_last=True,
+                                            sharded=sharded,
+                                            window_shards=window_shards)
+    num_batches = min(num_batches, len(train_loader))
+    start, start_cpu = time.time(), cpu_time()
+    start_io = read_io()
+    batches = iter(train_loader)
+    for i, _ in enumerate(batches):
+        if i + 1 == num_batches:
+            break
+    elapsed = time.time() - start
+    # the workers read the store, this process only reads their batches
+    workers = getattr(train_loader, 'workers', [])
+    if workers:
+        io = np.sum([read_io(w.pid) for w in workers], axis=0)
+    else:
+        io = np.subtract(read_io(), start_io)
+    # the workers are reaped before the CPU time of the children is read
+    del batches
+    if getattr(train_loader, 'shutdown', None):
+        train_loader.shutdown()
+    num_samples = num_batches * batch_size
+    return {'num_batches': num_batches,
+            'samples_per_s': num_samples / elapsed,
+            'read_bytes_per_sample': io[0] / float(num_samples),
+            'storage_bytes_per_sample': io[1] / float(num_samples),
+            'cpu_ms_per_sample': (cpu_time() - start_cpu) * 1000.0 / num_samples}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', default=None, help='Existing data dir whose seq_diff_train store is read instead of a synthetic one [default: None]')
+    parser.add_argument('--tmp_dir', default=None, help='Where to write the synthetic store and the shards [default: system temp dir]')
+    parser.add_argument('--num_clips', type=int, default=256, help='Clips of the synthetic store [default: 256]')
+    parser.add_argument('--codecs', default='zlib,lz4,zstd', help='Codecs of the compressed shards, the ones not installed are skipped [default: zlib,lz4,zstd]')
+    parser.add_argument('--level', type=int, default=None, help='Compression level [default: fast level of each codec]')
+    parser.add_argument('--chunk_clips', type=int, default=8, help='Clips per compressed chunk [default: 8]')
+    parser.add_argument('--shard_size', type=int, default=64, help='Clips per shard [default: 64]')
+    parser.add_argument('--window_shards', type=int, default=4, help='Shards open at a time in the sampler [default: 4]')
+    parser.add_argument('--workers', default='0,4', help='Numbers of loader workers [default: 0,4]')
+    parser.add_argument('--batch_size', type=int, default=32, help='Batch size [default: 32]')
+    parser.add_argument('--num_batches', type=int, default=50, help='Batches timed per run [default: 50]')
+    parser.add_argument('--num_segs', type=int, default=8, help='Segments per clip [default: 8]')
+    parser.add_argument('--seg_length', type=int, default=80, help='Frames per segment [default: 80]')
+    parser.add_argument('--drop_caches', action='store_true', help='Drop the page cache before every loader run, needs root')
+    parser.add_argument('--output', default='shard_bench.json', help='Result file [default: shard_bench.json]')
+    FLAGS = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(dir=FLAGS.tmp_dir)
+    if FLAGS.data is not None:
+        data_root = FLAGS.data
+    else:
+        data_root = os.path.join(tmp_dir, 'npy')
+        make_store(data_root, FLAGS.num_clips, 'float32')
+    codecs = []
+    for codec in FLAGS.codecs.split(','):
+        if codec in shard_store.available_codecs():
+            codecs.append(codec)
+        else:
+            print('Skipping %s, its package is not installed' % codec)
+
+    runs = []
+    try:
+        # (name, data root, sharded)
+        formats = [('npy', data_root, False)]
+        for codec in [None] + codecs:
+            name = 'raw' if codec is None else codec
+            root = os.path.join(tmp_dir, name)
+            shard_store.convert_store(os.path.join(data_root, STORE),
+                                      os.path.join(root, STORE + feature_store.SHARDED_SUFFIX),
+                                      'X_train', FLAGS.shard_size, codec=codec,
+                                      level=FLAGS.level, chunk_clips=FLAGS.chunk_clips)
+            formats.append((name, root, True))
+
+        raw_bytes = None
+        for name, root, sharded in formats:
+            store_path = os.path.join(root, STORE + (feature_store.SHARDED_SUFFIX if sharded else ''))
+            feats = feature_store.FeatureStore(store_path)['X_train']
+            num_bytes = stored_bytes(os.path.join(store_path, 'X_train'))
+            if raw_bytes is None:
+                raw_bytes = num_bytes
+            decode_time, decode_cpu = decode_cost(feats)
+            clip_mb = np.prod(feats.shape[1:]) * feats.dtype.itemsize / 1e6
+            result = {'format': name, 'num_clips': len(feats),
+                      'stored_bytes_per_clip': num_bytes / float(len(feats)),
+                      'compression_ratio': raw_bytes / float(num_bytes),
+                      'read_ms_per_clip': decode_time * 1000.0 / len(feats),
+                      'read_cpu_ms_per_clip': decode_cpu * 1000.0 / len(feats),
+                      'read_mb_per_s': clip_mb * len(feats) / decode_time}
+            for num_workers in [int(w) for w in FLAGS.workers.split(',')]:
+                if FLAGS.drop_caches:
+                    drop_caches()
+                run = dict(result, num_workers=num_workers)
+                # passes enough for num_batches batches on small stores
+                train_repeat = max(1.0, FLAGS.num_batches * FLAGS.batch_size / float(len(feats)))
+                run.update(benchmark(root, sharded, num_workers, FLAGS.batch_size,
+                                     FLAGS.num_batches, FLAGS.window_shards,
+                                     FLAGS.num_segs, FLAGS.seg_length, train_repeat))
+                run['read_amplification'] = (run['read_bytes_per_sample']
+                                             / run['stored_bytes_per_clip'])
+                print(json.dumps(run))
+                runs.append(run)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    with open(FLAGS.output, 'w') as f:
+        json.dump({'host': socket.gethostname(), 'cpu_count': os.cpu_count(),
+                   'args': vars(FLAGS), 'codecs': codecs, 'runs': runs}, f, indent=2)
@@ -21,9 +21,13 @@ sys.path.append(os.path.join(ROOT_DIR, 'utils'))
 
 import tf_util
 import dataloader
+import tf_dataloader
+import tf_frontend
 from dict_restore import DictRestore
 import spec_transforms
 import target_transforms
+import feature_store
+import soundfile as sound
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--gpu', default='0', help='GPU to use [default: GPU 0]')
@@ -38,6 +42,11 @@ parser.add_argument('--num_classes', type=int, default=10, help='Number of class
 parser.add_argument('--num_threads', type=int, default=24, help='Number of threads to use in loading data [default: 24]')
 parser.add_argument('--sn', type=int, default=4, help='Number of Semantic Neighbors [default: 4]')
 parser.add_argument('--fcn', type=int, default=0, help='Whether to use all spatial in evaluation [default: 0]')
+parser.add_argument('--tf_data', action='store_true', help='Feed the network from a tf.data pipeline instead of feed_dict')
+parser.add_argument('--raw_wav', action='store_true', help='Feed the raw waveforms of the fold list wav files (DATA/evaluation_setup) and compute the Log-Mels in the graph, see utils/tf_frontend.py')
+parser.add_argument('--train_split', default=None, help='Fold list of the normalization statistics of the shared store, e.g. fold1_train [default: None]')
+parser.add_argument('--eval_split', default=None, help='Fold list to evaluate from the shared store, e.g. fold1_evaluate [default: seq_diff_val/seq16_diff_test stores]')
+parser.add_argument('--stats_file', default=None, help='Normalization statistics [default: DATA/seq_diff_train/stats.npz if present, else DCASE 2019 values]')
 parser.add_argument('--command_file', default=None, help=' [Shell command file to use default: None]')
 FLAGS = parser.parse_args()
 
@@ -60,7 +69,11 @@ TIMEBINS = FLAGS.timebins
 NUM_THREADS = FLAGS.num_threads
 SN = FLAGS.sn
 COMMAND_FILE = FLAGS.command_file
+EVAL_SPLIT = FLAGS.eval_split
+STATS_FILE = FLAGS.stats_file if FLAGS.stats_file is not None else feature_store.find_stats(FLAGS.data, split=FLAGS.train_split)
 FCN = FLAGS.fcn
+TF_DATA = FLAGS.tf_data
+RAW_WAV = FLAGS.raw_wav
 
 MODEL_FILE = os.path.join(os.path.dirname(FLAGS.model_path), FLAGS.model+'.py')
 if not os.path.exists(DUMP_DIR): os.mkdir(DUMP_DIR)
@@ -76,13 +89,46 @@ NUM_CLASSES = FLAGS.num_classes
 HOSTNAME = socket.gethostname()
 
 # validation transform
-normalize = spec_transforms.ToNormalizedTensor()
+normalize = spec_transforms.ToNormalizedTensor(STATS_FILE)
 val_transform = spec_transforms.Compose([normalize])
 target_transform = target_transforms.ClassLabel()
 
 loader_bsize = 1
 
-if FCN > 1:
+def wav_batches(dataset):
+    """(1, num_samples, 2) waveform and label batches of the clips of a fold list dataset."""
+    for i in range(len(dataset)):
+        s, _ = sound.read(os.path.join(dataset.feats.root, dataset.audio_ids[i]), dtype='float32')
+        yield s[None], dataset.labels[i:i + 1]
+
+if RAW_WAV:
+    # only the clip list is used, the wav files are decoded by wav_batches
+    _, val_data, test_data = dataloader.get_datasets(DATA, None, None, target_transform,
+                                                     num_segs=NUM_SEGS,
+                                                     training=False, val=FCN <= 1, test=FCN > 1,
+                                                     seg_length=TIMEBINS,
+                                                     channels_last=True,
+                                                     val_split=EVAL_SPLIT, test_split=EVAL_SPLIT,
+                                                     from_wav=True)
+    wav_data = val_data if FCN <= 1 else test_data
+    val_loader = wav_batches(wav_data)
+elif TF_DATA:
+    # the multi-crop inputs are cut by the input pipeline
+    _, val_loader, test_loader = tf_dataloader.get_loader(root=DATA,
+                                                          train_transform=None,
+                                                          val_transform=val_transform,
+                                                          target_transform=target_transform,
+                                                          batch_size=loader_bsize,
+                                                          num_segs=NUM_SEGS,
+                                                          val_samples=1,
+                                                          n_threads=NUM_THREADS,
+                                                          training=False, val=FCN <= 1, test=FCN > 1,
+                                                          seg_length=TIMEBINS,
+                                                          eval_map_fn=lambda x, y: tf_dataloader.fcn_crops(x, y, NUM_SEGS, FCN),
+                                                          val_split=EVAL_SPLIT, test_split=EVAL_SPLIT)
+    if FCN > 1:
+        val_loader = test_loader
+elif FCN > 1:
     
     _, _, val_loader = dataloader.get_loader(root=DATA,
                                              train_transform=None,
@@ -92,7 +138,10 @@ if FCN > 1:
                                              num_segs=NUM_SEGS,
                                              val_samples=1,
                                              n_threads=NUM_THREADS,
-                                             training=False, val=False, test=True)
+                                             training=False, val=False, test=True,
+                                             seg_length=TIMEBINS,
+                                             channels_last=True,
+                                             val_split=EVAL_SPLIT, test_split=EVAL_SPLIT)
 else:
     _, val_loader = dataloader.get_loader(root=DATA,
                                           train_transform=None,
@@ -102,7 +151,10 @@ else:
                                           num_segs=NUM_SEGS,
                                           val_samples=1,
                                           n_threads=NUM_THREADS,
-                                          training=False, val=True, test=False)
+                                          training=False, val=True, test=False,
+                                          seg_length=TIMEBINS,
+                                          channels_last=True,
+                                          val_split=EVAL_SPLIT, test_split=EVAL_SPLIT)
 
 def log_string(out_str):
     LOG_FOUT.write(out_str+'\n')
@@ -124,7 +176,20 @@ def evaluate():
         assert(pl_bsize % NUM_GPUS == 0)
         DEVICE_BATCH_SIZE = pl_bsize // NUM_GPUS
 
-        audio_pl, labels_pl = MODEL.placeholder_inputs(pl_bsize, NUM_SEGS, FREQBINS, TIMEBINS, evaluate=True)
+        if TF_DATA:
+            iterator = val_loader.build().make_initializable_iterator()
+            audio_pl, labels_pl = iterator.get_next()
+        elif RAW_WAV:
+            # the multi-crop inputs are cut in the graph, like with --tf_data
+            num_samples = sound.info(os.path.join(wav_data.feats.root, wav_data.audio_ids[0])).frames
+            waveforms_pl = tf_frontend.waveform_placeholder(loader_bsize, num_samples)
+            clip_labels_pl = tf.placeholder(tf.int32, shape=(loader_bsize))
+            segments = tf_frontend.logmel_segments(waveforms_pl, NUM_SEGS if FCN <= 1 else 2 * NUM_SEGS,
+                                                   TIMEBINS, num_frames=wav_data.feats.num_frames,
+                                                   mean=normalize.mean, std=normalize.std)
+            audio_pl, labels_pl = tf_dataloader.fcn_crops(segments, clip_labels_pl, NUM_SEGS, FCN)
+        else:
+            audio_pl, labels_pl = MODEL.placeholder_inputs(pl_bsize, NUM_SEGS, FREQBINS, TIMEBINS, evaluate=True)
         is_training_pl = tf.placeholder(tf.bool, shape=())
 
         MODEL.get_model(audio_pl, is_training_pl, NUM_CLASSES, sn=SN)
@@ -175,6 +240,11 @@ def evaluate():
                'labels_pl': labels_pl,
                'is_training_pl': is_training_pl,
                'pred': pred}
+        if TF_DATA:
+            ops['init_op'] = iterator.initializer
+        if RAW_WAV:
+            ops['waveforms_pl'] = waveforms_pl
+            ops['clip_labels_pl'] = clip_labels_pl
 
         eval_one_epoch(sess, ops, val_loader)
 
@@ -189,13 +259,28 @@ def eval_one_epoch(sess, ops, val_loader, topk=1):
     loss_sum = 0
     batch_idx = 0
 
-    for batch_idx, (inputs, targets) in enumerate(val_loader):
-        batch_data = inputs.data.numpy()
-        bsize = batch_data.shape[0]
-        batch_label = targets.data.numpy()
-        batch_data = np.transpose(batch_data, [0,2,3,4,1])
-
-        if FCN == 10:
+    if TF_DATA:
+        sess.run(ops['init_op'])
+        batches = range(len(val_loader))
+    else:
+        batches = val_loader
+    for batch_idx, batch in enumerate(batches):
+        if not TF_DATA:
+            # batch_data shape: B*S*F*T*C, ready to feed
+            batch_data, batch_label = batch
+            bsize = batch_data.shape[0]
+
+        if TF_DATA:
+            # the crops of the clip come out of the input pipeline
+            pred_val, batch_label = sess.run([ops['pred'], ops['labels_pl']],
+                                             feed_dict={ops['is_training_pl']: is_training})
+        elif RAW_WAV:
+            # batch_data: the B*N*2 waveforms, cut into crops by the graph
+            feed_dict = {ops['waveforms_pl']: batch_data,
+                         ops['clip_labels_pl']: batch_label,
+                         ops['is_training_pl']: is_training}
+            pred_val = sess.run(ops['pred'], feed_dict=feed_dict)
+        elif FCN == 10:
             preds = []
             for i in range(bsize):
                 batch_data_split = np.expand_dims(batch_data[i], 0)
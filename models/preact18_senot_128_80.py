@@ -117,11 +117,8 @@ def get_loss(pred, label, end_points):
     if label.shape.ndims == 1:
         loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=pred, labels=label)
     else:
-        single_label = tf.cast(tf.argmax(label, axis=1), tf.int32)
-        '''loss = tf.losses.softmax_cross_entropy(
-                label, pred, label_smoothing=0.,
-                reduction=tf.losses.Reduction.NONE)'''
-        loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=pred, labels=single_label)
+        # soft cross entropy, mixup labels are not one-hot
+        loss = tf.nn.softmax_cross_entropy_with_logits_v2(logits=pred, labels=label)
     #loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=pred, labels=label)
     classify_loss = tf.reduce_mean(loss)
     tf.summary.scalar('classify loss', classify_loss)
@@ -105,8 +105,12 @@ def get_model(sequence, is_training, num_classes=10, bn_decay=0.999, weight_deca
 
 def get_loss(pred, label, end_points):
     """ pred: B*NUM_CLASSES,
-        label: B, """
-    loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=pred, labels=label)
+        label: B*NUM_CLASSES for one-hot, B, for normal labels"""
+    if label.shape.ndims == 1:
+        loss = tf.nn.sparse_softmax_cross_entropy_with_logits(logits=pred, labels=label)
+    else:
+        # soft cross entropy, mixup labels are not one-hot
+        loss = tf.nn.softmax_cross_entropy_with_logits_v2(logits=pred, labels=label)
     classify_loss = tf.reduce_mean(loss)
     tf.summary.scalar('classify loss', classify_loss)
     tf.add_to_collection('losses', classify_loss)
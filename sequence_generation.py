@@ -4,120 +4,286 @@
 # Description: Get log-mel sequence for wave files.
 # Dataset: DCASE-2019-Task1-ASC
 
+import argparse
+import collections
+import glob
+import io
+import multiprocessing
+import os
+import sys
 import numpy as np
 import pandas as pd
 import librosa
 import soundfile as sound
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = BASE_DIR
+sys.path.append(os.path.join(ROOT_DIR, 'utils'))
+
+import logmel_frontend
+import feature_store
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--data_path', default='../data/dcase2019/Task1a/dev/', help='Dataset folder holding the wav files and evaluation_setup/ [default: ../data/dcase2019/Task1a/dev/]')
+parser.add_argument('--splits', default='train=fold1_train,val=fold1_evaluate', help='Comma separated mode=list pairs, mode being train, val or test and list a fold list of evaluation_setup/ or a csv path, e.g. train=fold1_train,val=fold1_evaluate,test=fold1_test [default: train=fold1_train,val=fold1_evaluate]')
+parser.add_argument('--sr', type=int, default=48000, help='Sample rate of the wav files [default: 48000]')
+parser.add_argument('--duration', type=float, default=10, help='Clip duration in seconds, sets the number of frames [default: 10]')
+parser.add_argument('--n_mels', type=int, default=128, help='Number of mel bands [default: 128]')
+parser.add_argument('--n_fft', type=int, default=2048, help='FFT size [default: 2048]')
+parser.add_argument('--hop_length', type=int, default=0, help='Hop between frames in samples [default: n_fft/2]')
+parser.add_argument('--fmin', type=float, default=0.0, help='Lowest mel band edge in Hz [default: 0]')
+parser.add_argument('--fmax', type=float, default=0.0, help='Highest mel band edge in Hz [default: sr/2]')
+parser.add_argument('--resample_sr', type=int, default=0, help='Resample to this rate (e.g. 32000 or 24000) before the STFT, with n_fft and hop scaled to keep the frames, 0 disables [default: 0]')
+parser.add_argument('--filter_half_len', type=int, default=10, help='Anti-aliasing filter half length of --resample_sr, shorter is faster [default: 10]')
+parser.add_argument('--num_workers', type=int, default=multiprocessing.cpu_count(), help='Number of extraction processes, 1 runs in-process [default: number of cores]')
+parser.add_argument('--max_pending', type=int, default=0, help='Clips extracted ahead of the writer, bounds peak memory [default: 2*num_workers]')
+parser.add_argument('--cache_dir', default=None, help='Per-clip feature cache, empty string disables it [default: DataPath/feature_cache]')
+parser.add_argument('--shared_store', action='store_true', help='Extract every clip of the fold lists once into seq_diff_all with per-list indices, instead of per-split stores')
+parser.add_argument('--dtype', default='float32', help='Storage format of the log-mels: float32, float16 or uint8 (per-clip, per-channel affine) [default: float32]')
+FLAGS = parser.parse_args()
 
 print("Librosa version = ",librosa.__version__)
 print("Pysoundfile version = ",sound.__version__)
 
 # File path
-DataPath = '../data/dcase2019/Task1a/dev/'
-TrainFile = DataPath + 'evaluation_setup/fold1_train.csv'
-ValFile = DataPath + 'evaluation_setup/fold1_evaluate.csv'
+DataPath = os.path.join(FLAGS.data_path, '')
+SetupFiles = sorted(glob.glob(DataPath + 'evaluation_setup/fold*.csv'))
+
+# Feature store of each mode, named as looked up by utils/dataloader.py
+STORE_NAMES = {'train': 'seq_diff_train',
+               'val': 'seq_diff_val',
+               'test': 'seq16_diff_test'}
 
 # Audio info
-sr = 48000
+sr = FLAGS.sr
 num_audio_channels = 2
 
 # Duration unit is second
-sample_duration = 10
+sample_duration = FLAGS.duration
 
 # Log-Mel configuration
-num_mel_banks = 128;
-num_fft_points = 2048;
-hop_length = int(num_fft_points/2)
+num_mel_banks = FLAGS.n_mels
+num_fft_points = FLAGS.n_fft
+hop_length = FLAGS.hop_length if FLAGS.hop_length > 0 else int(num_fft_points/2)
 num_frames = int(np.ceil(sample_duration*sr/hop_length))
 
-# Segmentation configuration
-seg_num = 8
-seg_length = 80
-
-# Load Wav filenames and labels
-train_data_list = pd.read_csv(TrainFile, sep='\t', encoding='ASCII')
-val_data_list = pd.read_csv(ValFile, sep='\t', encoding='ASCII')
-train_wav_paths = train_data_list['filename'].tolist()
-val_wav_paths = val_data_list['filename'].tolist()
-train_labels = train_data_list['scene_label'].astype('category').cat.codes.values
-val_labels = val_data_list['scene_label'].astype('category').cat.codes.values
-class_names = np.unique(train_data_list['scene_label'])
-num_classes = len(class_names)
-
-# Calculate hop_frames for segmentation
-def calculate_hop_frames(total_frames, segnum, seg_length):
-    hop_frames = int((total_frames-seg_length)/(seg_num-1))
-    return hop_frames
-
-# Generate segment-level Log-Mel spectrograms and their deltas
-# Training part
-X_train = np.zeros((len(train_wav_paths),seg_num,num_mel_banks,seg_length,
-                         num_audio_channels+1),'float32')
-for i in range(len(train_wav_paths)):
-    s, fs = sound.read(DataPath + train_wav_paths[i])
-    s_diff = s[:,0] - s[:,1]
-    s_diff = np.expand_dims(s_diff, -1)
-    s = np.concatenate((s, s_diff), axis=-1)
-    for channel in range(num_audio_channels+1):
-        if len(s.shape)==1:
-            s = np.expand_dims(s, -1)
-        logmel = librosa.feature.melspectrogram(s[:,channel],
-                                                sr = sr,
-                                                n_fft = num_fft_points,
-                                                hop_length = hop_length,
-                                                n_mels = num_mel_banks,
-                                                fmin = 0.0,
-                                                fmax = sr/2,
-                                                htk = True,
-                                                norm = None)
-        hop_frames = calculate_hop_frames(logmel.shape[1], seg_num, seg_length)
-        for seg in range(seg_num):
-            X_train[i,seg,:,:,channel] = logmel[:,
-                        (seg*hop_frames):(seg*hop_frames+seg_length)]
-        print('Generating Log-Mel for training wav file #%d complete!'%(i))
-X_train = np.log(X_train + 1e-8)
-
-# Validation part
-X_val = np.zeros((len(val_wav_paths),seg_num,num_mel_banks,seg_length,
-                       num_audio_channels+1),'float32')
-for i in range(len(val_wav_paths)):
-    s, fs = sound.read(DataPath + val_wav_paths[i])
-    s_diff = s[:,0] - s[:,1]
-    s_diff = np.expand_dims(s_diff, -1)
-    s = np.concatenate((s, s_diff), axis=-1)
-    for channel in range(num_audio_channels+1):
-        logmel = librosa.feature.melspectrogram(s[:,channel],
-                                                sr = sr,
-                                                n_fft = num_fft_points,
-                                                hop_length = hop_length,
-                                                n_mels = num_mel_banks,
-                                                fmin = 0.0,
-                                                fmax = sr/2,
-                                                htk = True,
-                                                norm = None)
-        hop_frames = calculate_hop_frames(logmel.shape[1], seg_num, seg_length)
-        for seg in range(seg_num):
-            X_val[i,seg,:,:,channel] = logmel[:,
-                      (seg*hop_frames):(seg*hop_frames+seg_length)]
-        print('Generating Log-Mel for validation wav file #%d complete!'%(i))
-X_val = np.log(X_val + 1e-8)
-
-
-# Get segment-level one hot labels
-#y_train = np.zeros((len(train_wav_paths)*seg_num, num_classes),'int')
-y_train = np.zeros((len(train_wav_paths)),'int')
-for i in range(len(train_wav_paths)):
-    y_train[i] = int(train_labels[i])
-
-#y_val = np.zeros((len(val_wav_paths)*seg_num, num_classes),'int')
-y_val = np.zeros((len(val_wav_paths)),'int')
-for i in range(len(val_wav_paths)):
-    y_val[i] = int(val_labels[i])
-
-# Save log-mels and labels
-np.savez(DataPath+'seq_diff_train.npz', X_train = X_train, y_train = y_train,
-         audio_ids = train_wav_paths,
-         class_names = class_names)
-np.savez(DataPath+'seq_diff_val.npz', X_val = X_val, y_val = y_val,
-         audio_ids = val_wav_paths,
-         class_names = class_names)
+# Mel filterbank and window are shared by all files (and inherited by the
+# forked workers)
+frontend = logmel_frontend.get_frontend(sr=sr, n_fft=num_fft_points,
+                                        hop_length=hop_length,
+                                        n_mels=num_mel_banks,
+                                        fmin=FLAGS.fmin,
+                                        fmax=FLAGS.fmax if FLAGS.fmax > 0 else sr/2,
+                                        resample_sr=FLAGS.resample_sr or None,
+                                        filter_half_len=FLAGS.filter_half_len)
+
+# Parallel configuration
+NUM_WORKERS = FLAGS.num_workers
+MAX_PENDING = FLAGS.max_pending if FLAGS.max_pending > 0 else 2 * NUM_WORKERS
+
+# Extraction configuration, recorded in the config.json of every store
+CONFIG = {'sr': sr,
+          'num_audio_channels': num_audio_channels,
+          'duration': sample_duration,
+          'num_mel_banks': num_mel_banks,
+          'num_fft_points': num_fft_points,
+          'hop_length': hop_length,
+          'fmin': frontend.fmin,
+          'fmax': frontend.fmax,
+          'pad_mode': frontend.pad_mode,
+          'num_frames': num_frames,
+          'resample_sr': frontend.resample_sr,
+          'filter_half_len': FLAGS.filter_half_len if frontend.resample_sr else None,
+          'dtype': FLAGS.dtype,
+          'librosa_version': librosa.__version__}
+
+# Feature cache configuration
+CacheDir = DataPath + 'feature_cache/' if FLAGS.cache_dir is None else FLAGS.cache_dir
+cache = None
+if CacheDir:
+    cache = feature_store.ClipCache(CacheDir, frontend.cache_config(num_frames))
+
+# Generate full-clip Log-Mel spectrograms for one wav file
+def compute_logmel(s):
+    """
+    Returns the (F, T, C) log-Mel spectrogram of one stereo signal, C being
+    left, right and left-right channels. All three channels go through one
+    batched float32 STFT. Segmentation is left to the loader.
+    """
+    return frontend.stereo_log_mel(s, num_frames)
+
+def extract_logmel(wav_path):
+    """
+    Log-Mel spectrogram of one wav file, taken from the feature cache when an
+    entry for the same file content and configuration exists.
+    Runs inside the worker processes, so the disk read of one file overlaps
+    with the STFTs of the files handled by the other workers.
+    """
+    with open(DataPath + wav_path, 'rb') as f:
+        data = f.read()
+    if cache is not None:
+        key = cache.key(data)
+        feat = cache.load(key)
+        if feat is not None:
+            return feat
+    s, fs = sound.read(io.BytesIO(data), dtype='float32')
+    feat = compute_logmel(s)
+    if cache is not None:
+        cache.save(key, feat)
+    return feat
+
+# Ordered Pool.imap with at most max_pending results in flight
+def imap_bounded(pool, func, iterable, max_pending):
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+# Generate full-clip Log-Mel spectrograms for a list of wav files
+def generate_logmels(wav_paths, split_name, X, stats=None):
+    """
+    Extracts all wav files of one split with NUM_WORKERS processes and
+    writes each clip into X, a FeatureWriter of the feature store, as soon
+    as it is ready. Results come back in input order, so X is identical to a
+    serial run, and at most MAX_PENDING clips are held in memory.
+    The normalization statistics are accumulated on the way: stats is a list
+    of (RunningStats, mask) pairs, each one counting the clips whose boolean
+    mask entry is set, or all clips for a None mask.
+    """
+    if NUM_WORKERS > 1:
+        pool = multiprocessing.Pool(NUM_WORKERS)
+        results = imap_bounded(pool, extract_logmel, wav_paths, MAX_PENDING)
+    else:
+        pool = None
+        results = map(extract_logmel, wav_paths)
+    for i, feat in enumerate(results):
+        X[i] = feat
+        for split_stats, mask in stats or []:
+            if mask is None or mask[i]:
+                split_stats.update(feat)
+        print('Generating Log-Mel for %s wav file #%d complete!'%(split_name, i))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    X.flush()
+
+# Fold lists
+def find_setup_file(name):
+    """A csv path, or the name of a fold list of evaluation_setup/."""
+    if name.endswith('.csv'):
+        return name
+    return DataPath + 'evaluation_setup/' + name + '.csv'
+
+def read_list(setup_file):
+    return pd.read_csv(setup_file, sep='\t', encoding='ASCII')
+
+def get_class_names(data_lists):
+    """Sorted scene labels of all the annotated lists."""
+    labelled_lists = [l for l in data_lists if 'scene_label' in l]
+    if not labelled_lists:
+        return np.array([''])
+    return np.unique(np.concatenate([l['scene_label'].values for l in labelled_lists])).astype(str)
+
+def list_labels(data_list, class_names):
+    """Class indices of the clips of a list, -1 for a list without scene_label."""
+    if 'scene_label' not in data_list:
+        return -np.ones(len(data_list), 'int')
+    return np.searchsorted(class_names, data_list['scene_label'].values.astype(str))
+
+# Generate the feature store of one split
+def generate_split(mode, setup_file, class_names):
+    """
+    Extracts the clips of one fold list into the store of mode (train, val or
+    test), with their labels, the normalization statistics of the training
+    split and the extraction configuration.
+    """
+    data_list = read_list(setup_file)
+    wav_paths = data_list['filename'].tolist()
+    Store = DataPath + STORE_NAMES[mode]
+
+    X = feature_store.FeatureWriter(Store, 'X_' + mode, len(wav_paths),
+                    (num_mel_banks,num_frames,num_audio_channels+1), FLAGS.dtype)
+    stats = []
+    if mode == 'train':
+        train_stats = feature_store.RunningStats(num_audio_channels+1)
+        stats.append((train_stats, None))
+    generate_logmels(wav_paths, mode, X, stats)
+    del X
+    if mode == 'train':
+        train_stats.save(Store)
+
+    # Save labels next to the log-mels
+    feature_store.save_array(Store, 'y_' + mode, list_labels(data_list, class_names))
+    feature_store.save_array(Store, 'audio_ids', np.asarray(wav_paths, dtype=str))
+    feature_store.save_array(Store, 'class_names', class_names)
+    feature_store.save_config(Store, dict(CONFIG, mode=mode,
+                                          setup_file=os.path.basename(setup_file),
+                                          num_clips=len(wav_paths)))
+
+# Generate the shared store of all fold lists
+def generate_shared_store(setup_files):
+    """
+    Extracts every clip listed in any of the setup_files once into the
+    shared store, writes one index array of store positions per list and
+    the normalization statistics of every training list.
+    """
+    data_lists = collections.OrderedDict()
+    for setup_file in setup_files:
+        split = os.path.splitext(os.path.basename(setup_file))[0]
+        data_lists[split] = read_list(setup_file)
+    wav_paths = sorted(set().union(*[l['filename'] for l in data_lists.values()]))
+    positions = {wav_path: i for i, wav_path in enumerate(wav_paths)}
+
+    # Labels of the annotated lists, -1 for clips without scene_label
+    class_names = get_class_names(data_lists.values())
+    y_all = -np.ones(len(wav_paths), 'int')
+    for data_list in data_lists.values():
+        if 'scene_label' in data_list:
+            index = [positions[wav_path] for wav_path in data_list['filename']]
+            y_all[index] = list_labels(data_list, class_names)
+
+    Store = DataPath + feature_store.SHARED_STORE
+    stats = []
+    for split, data_list in data_lists.items():
+        index = np.array([positions[wav_path] for wav_path in data_list['filename']], 'int')
+        feature_store.save_array(Store, feature_store.index_key(split), index)
+        if split.endswith('_train'):
+            mask = np.zeros(len(wav_paths), bool)
+            mask[index] = True
+            stats.append((split, feature_store.RunningStats(num_audio_channels+1), mask))
+
+    X_all = feature_store.FeatureWriter(Store, 'X_all', len(wav_paths),
+                    (num_mel_banks,num_frames,num_audio_channels+1), FLAGS.dtype)
+    generate_logmels(wav_paths, 'all', X_all, [(s, mask) for _, s, mask in stats])
+    del X_all
+    for split, split_stats, _ in stats:
+        split_stats.save(Store, split)
+
+    feature_store.save_array(Store, 'y_all', y_all)
+    feature_store.save_array(Store, 'audio_ids', np.asarray(wav_paths, dtype=str))
+    feature_store.save_array(Store, 'class_names', class_names)
+    feature_store.save_config(Store, dict(CONFIG,
+                                          setup_files=[os.path.basename(f) for f in setup_files],
+                                          num_clips=len(wav_paths)))
+
+
+if __name__ == '__main__':
+    if FLAGS.shared_store:
+        generate_shared_store(SetupFiles)
+        sys.exit(0)
+
+    # mode=list pairs, the class names are shared by all the splits
+    splits = collections.OrderedDict()
+    for item in FLAGS.splits.split(','):
+        mode, name = item.split('=')
+        if mode not in STORE_NAMES:
+            raise ValueError('Unknown mode %s in --splits, expected one of %s'
+                             % (mode, ', '.join(sorted(STORE_NAMES))))
+        splits[mode] = find_setup_file(name)
+    class_names = get_class_names([read_list(f) for f in splits.values()])
+
+    # Generate full-clip Log-Mel spectrograms, one store per split
+    for mode, setup_file in splits.items():
+        generate_split(mode, setup_file, class_names)
@@ -23,9 +23,11 @@ sys.path.append(os.path.join(ROOT_DIR, 'models'))
 
 import tf_util
 import dataloader
+import tf_dataloader
 from dict_restore import DictRestore
 import spec_transforms
 import target_transforms
+import feature_store
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--gpu', default='0', help='GPU to use [default: GPU 0]')
@@ -40,6 +42,10 @@ parser.add_argument('--timebins', type=int, default=80, help='Video image timebi
 parser.add_argument('--num_classes', type=int, default=10, help='Number of classes [default: 400]')
 parser.add_argument('--num_threads', type=int, default=24, help='Number of threads to use in loading data [default: 24]')
 parser.add_argument('--fcn', type=int, default=3, help='Whether to use all spatial in evaluation [default: 0]')
+parser.add_argument('--tf_data', action='store_true', help='Feed the network from a tf.data pipeline instead of feed_dict')
+parser.add_argument('--train_split', default=None, help='Fold list of the normalization statistics of the shared store, e.g. fold1_train [default: None]')
+parser.add_argument('--test_split', default=None, help='Fold list to test from the shared store, e.g. fold1_test [default: seq16_diff_test store]')
+parser.add_argument('--stats_file', default=None, help='Normalization statistics [default: DATA/seq_diff_train/stats.npz if present, else DCASE 2019 values]')
 parser.add_argument('--command_file', default=None, help=' [Shell command file to use default: None]')
 FLAGS = parser.parse_args()
 
@@ -62,7 +68,10 @@ FREQBINS = FLAGS.freqbins
 TIMEBINS = FLAGS.timebins
 NUM_THREADS = FLAGS.num_threads
 COMMAND_FILE = FLAGS.command_file
+TEST_SPLIT = FLAGS.test_split
+STATS_FILE = FLAGS.stats_file if FLAGS.stats_file is not None else feature_store.find_stats(FLAGS.data, split=FLAGS.train_split)
 FCN = FLAGS.fcn
+TF_DATA = FLAGS.tf_data
 
 MODEL_FILE = os.path.join(os.path.dirname(FLAGS.model_path), FLAGS.model+'.py')
 if not os.path.exists(DUMP_DIR): os.mkdir(DUMP_DIR)
@@ -78,21 +87,39 @@ NUM_CLASSES = FLAGS.num_classes
 HOSTNAME = socket.gethostname()
 
 # validation transform
-normalize = spec_transforms.ToNormalizedTensor()
+normalize = spec_transforms.ToNormalizedTensor(STATS_FILE)
 val_transform = spec_transforms.Compose([normalize])
 target_transform = target_transforms.ClassLabel()
 
 loader_bsize = 1
 
-_, _, test_loader = dataloader.get_loader(root=DATA,
-                                          train_transform=None,
-                                          val_transform=val_transform,
-                                          target_transform=target_transform,
-                                          batch_size=loader_bsize,
-                                          num_segs=NUM_SEGS,
-                                          val_samples=1,
-                                          n_threads=NUM_THREADS,
-                                          training=False, val=False, test=True)
+if TF_DATA:
+    # the multi-crop inputs are cut by the input pipeline
+    _, _, test_loader = tf_dataloader.get_loader(root=DATA,
+                                                 train_transform=None,
+                                                 val_transform=val_transform,
+                                                 target_transform=target_transform,
+                                                 batch_size=loader_bsize,
+                                                 num_segs=NUM_SEGS,
+                                                 val_samples=1,
+                                                 n_threads=NUM_THREADS,
+                                                 training=False, val=False, test=True,
+                                                 seg_length=TIMEBINS,
+                                                 eval_map_fn=lambda x, y: tf_dataloader.fcn_crops(x, y, NUM_SEGS, FCN),
+                                                 test_split=TEST_SPLIT)
+else:
+    _, _, test_loader = dataloader.get_loader(root=DATA,
+                                              train_transform=None,
+                                              val_transform=val_transform,
+                                              target_transform=target_transform,
+                                              batch_size=loader_bsize,
+                                              num_segs=NUM_SEGS,
+                                              val_samples=1,
+                                              n_threads=NUM_THREADS,
+                                              training=False, val=False, test=True,
+                                              seg_length=TIMEBINS,
+                                              channels_last=True,
+                                              test_split=TEST_SPLIT)
 
 audio_list = DATA + 'evaluation_setup/fold1_evaluate.csv'
 audio_files = pd.read_csv(audio_list, sep='\t', encoding='ASCII')
@@ -119,7 +146,11 @@ def test():
         assert(pl_bsize % NUM_GPUS == 0)
         DEVICE_BATCH_SIZE = pl_bsize // NUM_GPUS
 
-        audio_pl, labels_pl = MODEL.placeholder_inputs(pl_bsize, NUM_SEGS, FREQBINS, TIMEBINS, evaluate=True)
+        if TF_DATA:
+            iterator = test_loader.build().make_initializable_iterator()
+            audio_pl, labels_pl = iterator.get_next()
+        else:
+            audio_pl, labels_pl = MODEL.placeholder_inputs(pl_bsize, NUM_SEGS, FREQBINS, TIMEBINS, evaluate=True)
         is_training_pl = tf.placeholder(tf.bool, shape=())
 
         MODEL.get_model(audio_pl, is_training_pl, NUM_CLASSES, pool_t=POOL_T)
@@ -170,6 +201,8 @@ def test():
                'labels_pl': labels_pl,
                'is_training_pl': is_training_pl,
                'pred': pred}
+        if TF_DATA:
+            ops['init_op'] = iterator.initializer
 
         test_one_epoch(sess, ops, test_loader)
 
@@ -183,13 +216,22 @@ def test_one_epoch(sess, ops, test_loader, topk=1):
 
     pred_vals = {}
 
-    for batch_idx, (inputs, targets) in enumerate(test_loader):
-        batch_data = inputs.data.numpy()
-        bsize = batch_data.shape[0]
-        batch_label = targets.data.numpy()
-        batch_data = np.transpose(batch_data, [0,2,3,4,1])
-
-        if FCN == 10:
+    if TF_DATA:
+        sess.run(ops['init_op'])
+        batches = range(len(test_loader))
+    else:
+        batches = test_loader
+    for batch_idx, batch in enumerate(batches):
+        if not TF_DATA:
+            # batch_data shape: B*S*F*T*C, ready to feed
+            batch_data, batch_label = batch
+            bsize = batch_data.shape[0]
+
+        if TF_DATA:
+            # the crops of the clip come out of the input pipeline
+            pred_val, batch_label = sess.run([ops['pred'], ops['labels_pl']],
+                                             feed_dict={ops['is_training_pl']: is_training})
+        elif FCN == 10:
             preds = []
             for i in range(bsize):
                 batch_data_split = np.expand_dims(batch_data[i], 0)
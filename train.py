@@ -16,7 +16,6 @@ import socket
 import importlib
 import os
 import sys
-import torch
 import random
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR = BASE_DIR
@@ -26,10 +25,14 @@ sys.path.append(os.path.join(ROOT_DIR, 'utils'))
 
 import tf_util
 import dataloader
+import tf_dataloader
+import tf_augment
 from dict_restore import DictRestore
 from saver_restore import SaverRestore
 import spec_transforms
 import target_transforms
+import batch_augment
+import feature_store
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--gpu', default='0,1', help='GPU to use [default: GPU 0,1]')
@@ -55,9 +58,24 @@ parser.add_argument('--sn', type=int, default=4, help='Number of Semantic Neighb
 parser.add_argument('--symmetric_flip_labels', default=None, help='The left-right label pairs [default: None]')
 parser.add_argument('--mixup', type=bool, default=False, help='MixUp the data [default: False]')
 parser.add_argument('--mixup_alpha', type=float, default=0.4, help='Alpha for MixUp [default: 0.4]')
+parser.add_argument('--spec_augment', action='store_true', help='SpecAugment time and frequency masking of the training batches')
 parser.add_argument('--reset_lr', action='store_true', help='Reset learning rate instead of continue with last training')
 parser.add_argument('--freeze_bn', action='store_true', help='Freeze all batch norm layers')
 parser.add_argument('--debug', action='store_true', help='Whether to debug load model')
+parser.add_argument('--tf_data', action='store_true', help='Feed the network from a tf.data pipeline instead of feed_dict')
+parser.add_argument('--shared_memory', action='store_true', help='Hand batches over from the loader workers through shared memory')
+parser.add_argument('--train_split', default=None, help='Fold list to train on from the shared store, e.g. fold1_train [default: seq_diff_train store]')
+parser.add_argument('--val_split', default=None, help='Fold list to validate on from the shared store, e.g. fold1_evaluate [default: seq_diff_val store]')
+parser.add_argument('--from_wav', action='store_true', help='Compute the log-mels of the fold list wav files in the loader instead of reading a feature store')
+parser.add_argument('--wav_cache_size', type=int, default=256, help='Clips cached per loader worker with --from_wav [default: 256]')
+parser.add_argument('--wav_disk_cache', default=None, help='Folder of the on-disk tier of the --from_wav cache, e.g. the feature_cache folder of sequence_generation.py [default: None]')
+parser.add_argument('--resample_sr', type=int, default=0, help='Analysis sample rate of the --from_wav log-mels, e.g. 32000 or 24000, 0 keeps the wav rate [default: 0]')
+parser.add_argument('--filter_half_len', type=int, default=10, help='Anti-aliasing filter half length of --resample_sr, shorter is faster [default: 10]')
+parser.add_argument('--cache_mb', type=int, default=0, help='MB of hot clips kept in memory per loader worker in front of the feature store, 0 disables [default: 0]')
+parser.add_argument('--cache_policy', default='lru', help='Eviction policy of the in-memory clip caches, lru or lfu [default: lru]')
+parser.add_argument('--sharded', action='store_true', help='Read the sharded copy of the training store, e.g. seq_diff_train_shards, see utils/shard_store.py')
+parser.add_argument('--window_shards', type=int, default=8, help='Shards open at a time when drawing the --sharded training clips, the shuffle buffer, split among the loader workers [default: 8]')
+parser.add_argument('--stats_file', default=None, help='Normalization statistics [default: DATA/seq_diff_train/stats.npz if present, else DCASE 2019 values]')
 parser.add_argument('--command_file', default=None, help=' [Shell command file to use default: None]')
 FLAGS = parser.parse_args()
 
@@ -92,7 +110,22 @@ DEBUG = FLAGS.debug
 SYMMETRIC_FLIP_LABELS = FLAGS.symmetric_flip_labels
 MIXUP = FLAGS.mixup
 MIXUP_ALPHA = FLAGS.mixup_alpha
+SPEC_AUGMENT = FLAGS.spec_augment
 COMMAND_FILE = FLAGS.command_file
+TF_DATA = FLAGS.tf_data
+SHARED_MEMORY = FLAGS.shared_memory
+TRAIN_SPLIT = FLAGS.train_split
+VAL_SPLIT = FLAGS.val_split
+FROM_WAV = FLAGS.from_wav
+WAV_CACHE_SIZE = FLAGS.wav_cache_size
+WAV_DISK_CACHE = FLAGS.wav_disk_cache
+RESAMPLE_SR = FLAGS.resample_sr or None
+FILTER_HALF_LEN = FLAGS.filter_half_len
+CACHE_BYTES = FLAGS.cache_mb * 1024 * 1024
+CACHE_POLICY = FLAGS.cache_policy
+SHARDED = FLAGS.sharded
+WINDOW_SHARDS = FLAGS.window_shards
+STATS_FILE = FLAGS.stats_file if FLAGS.stats_file is not None else feature_store.find_stats(FLAGS.data, split=TRAIN_SPLIT, sharded=SHARDED)
 
 MODEL = importlib.import_module(FLAGS.model) # import network module
 MODEL_FILE = os.path.join(ROOT_DIR, 'models', FLAGS.model+'.py')
@@ -107,21 +140,80 @@ LOG_FOUT = open(os.path.join(LOG_DIR, 'log_train.txt'), 'w')
 LOG_FOUT.write(str(FLAGS)+'\n')
 
 # train normalization
-normalize = spec_transforms.ToNormalizedTensor()
-train_transform = spec_transforms.Compose([normalize])
+normalize = spec_transforms.ToNormalizedTensor(STATS_FILE)
+if SPEC_AUGMENT:
+    train_transform = spec_transforms.Compose([normalize, spec_transforms.SpecAugment(seed=0)])
+else:
+    train_transform = spec_transforms.Compose([normalize])
 # validation normalization
 val_transform = spec_transforms.Compose([normalize])
 target_transform = target_transforms.ClassLabel()
 
-train_loader, val_loader = dataloader.get_loader(root=DATA, 
-                                                 train_transform=train_transform, 
-                                                 val_transform=val_transform, 
-                                                 target_transform=target_transform,
-                                                 batch_size=BATCH_SIZE, 
-                                                 num_segs=NUM_SEGS,  
-                                                 val_samples=1, 
-                                                 n_threads=NUM_THREADS,
-                                                 training=True, val=True, test=False)
+def augment_batch(batch_data, batch_label):
+    """ In-place batch augmentation of the loader batches, labels are one-hot with mixup """
+    # batch_data shape: B*S*F*T*C
+    if SYMMETRIC_FLIP_LABELS is not None:
+        batch_data, batch_label = batch_augment.time_flip(batch_data, batch_label, FLIP_MAP)
+    batch_data = batch_augment.swap_channels(batch_data)
+    if MIXUP:
+        batch_data, batch_label = batch_augment.mixup(batch_data, batch_label, MIXUP_ALPHA, NUM_CLASSES)
+    return batch_data, batch_label
+
+def augment_graph(batch_data, batch_label):
+    """ Graph version of augment_batch, for the tf.data pipeline """
+    if SYMMETRIC_FLIP_LABELS is not None:
+        batch_data, batch_label = tf_augment.time_flip(batch_data, batch_label, FLIP_MAP)
+    batch_data = tf_augment.swap_channels(batch_data)
+    if MIXUP:
+        batch_data, batch_label = tf_augment.mixup(batch_data, batch_label, MIXUP_ALPHA, NUM_CLASSES)
+    return batch_data, batch_label
+
+def one_hot_graph(batch_data, batch_label):
+    """ One-hot validation labels, to match the mixup training labels """
+    return batch_data, tf.one_hot(batch_label, NUM_CLASSES)
+
+if TF_DATA:
+    train_loader, val_loader = tf_dataloader.get_loader(root=DATA,
+                                                        train_transform=train_transform,
+                                                        val_transform=val_transform,
+                                                        target_transform=target_transform,
+                                                        batch_size=BATCH_SIZE,
+                                                        num_segs=NUM_SEGS,
+                                                        val_samples=1,
+                                                        n_threads=NUM_THREADS,
+                                                        training=True, val=True, test=False,
+                                                        seg_length=TIMEBINS,
+                                                        train_map_fn=augment_graph,
+                                                        eval_map_fn=one_hot_graph if MIXUP else None,
+                                                        train_split=TRAIN_SPLIT, val_split=VAL_SPLIT,
+                                                        from_wav=FROM_WAV, cache_size=WAV_CACHE_SIZE,
+                                                        cache_bytes=CACHE_BYTES, cache_policy=CACHE_POLICY,
+                                                        disk_cache=WAV_DISK_CACHE,
+                                                        resample_sr=RESAMPLE_SR, filter_half_len=FILTER_HALF_LEN,
+                                                        sharded=SHARDED, window_shards=WINDOW_SHARDS)
+else:
+    train_loader, val_loader = dataloader.get_loader(root=DATA, 
+                                                     train_transform=train_transform, 
+                                                     val_transform=val_transform, 
+                                                     target_transform=target_transform,
+                                                     batch_size=BATCH_SIZE, 
+                                                     num_segs=NUM_SEGS,  
+                                                     val_samples=1, 
+                                                     n_threads=NUM_THREADS,
+                                                     training=True, val=True, test=False,
+                                                     seg_length=TIMEBINS,
+                                                     channels_last=True,
+                                                     shared_memory=SHARED_MEMORY,
+                                                     train_split=TRAIN_SPLIT, val_split=VAL_SPLIT,
+                                                     from_wav=FROM_WAV, cache_size=WAV_CACHE_SIZE,
+                                                     cache_bytes=CACHE_BYTES, cache_policy=CACHE_POLICY,
+                                                     disk_cache=WAV_DISK_CACHE,
+                                                     resample_sr=RESAMPLE_SR, filter_half_len=FILTER_HALF_LEN,
+                                                     sharded=SHARDED, window_shards=WINDOW_SHARDS)
+    # fork the workers before TensorFlow starts its session threads, the
+    # train and val loaders share them unless SHARED_MEMORY
+    if NUM_THREADS > 0 or SHARED_MEMORY:
+        train_loader.start()
 DECAY_STEP = EPOCH_DECAY_STEP * len(train_loader)
 
 BN_INIT_DECAY = 0.5
@@ -142,6 +234,7 @@ if SYMMETRIC_FLIP_LABELS is not None:
         symmetric_flip_labels[int(p2)] = int(p1)
 
 print('symmetric pairs: ', symmetric_flip_labels)
+FLIP_MAP = batch_augment.flip_label_map(symmetric_flip_labels, NUM_CLASSES)
 
 def log_string(out_str):
     LOG_FOUT.write(out_str+'\n')
@@ -208,7 +301,17 @@ def get_bn_decay(batch):
 def train():
     with tf.Graph().as_default():
         with tf.device('/cpu:0'):
-            audio_pl, labels_pl = MODEL.placeholder_inputs(BATCH_SIZE, NUM_SEGS, FREQBINS, TIMEBINS, NUM_CLASSES)
+            if TF_DATA:
+                # one iterator over both pipelines, switched by its initializers
+                train_dataset = train_loader.build()
+                val_dataset = val_loader.build()
+                iterator = tf.data.Iterator.from_structure(train_dataset.output_types,
+                                                           train_dataset.output_shapes)
+                audio_pl, labels_pl = iterator.get_next()
+                train_init_op = iterator.make_initializer(train_dataset)
+                val_init_op = iterator.make_initializer(val_dataset)
+            else:
+                audio_pl, labels_pl = MODEL.placeholder_inputs(BATCH_SIZE, NUM_SEGS, FREQBINS, TIMEBINS, NUM_CLASSES, mixup=MIXUP)
             is_training_pl = tf.placeholder(tf.bool, shape=())
 
             # Note the global_step=batch parameter to minimize.
@@ -239,11 +342,13 @@ def train():
                         # Evenly split input data to each GPU
                         vd_batch = tf.slice(audio_pl,
                             [i*DEVICE_BATCH_SIZE,0,0,0,0], [DEVICE_BATCH_SIZE,-1,-1,-1,-1])
-                        #for one-hot labels
-                        #label_batch = tf.slice(labels_pl,
-                        #    [i*DEVICE_BATCH_SIZE, NUM_CLASSES], [DEVICE_BATCH_SIZE, NUM_CLASSES])
-                        label_batch = tf.slice(labels_pl,
-                            [i*DEVICE_BATCH_SIZE], [DEVICE_BATCH_SIZE])
+                        if MIXUP:
+                            #for one-hot labels
+                            label_batch = tf.slice(labels_pl,
+                                [i*DEVICE_BATCH_SIZE, 0], [DEVICE_BATCH_SIZE, NUM_CLASSES])
+                        else:
+                            label_batch = tf.slice(labels_pl,
+                                [i*DEVICE_BATCH_SIZE], [DEVICE_BATCH_SIZE])
 
                         pred, end_points = MODEL.get_model(vd_batch, num_classes=NUM_CLASSES if not DEBUG else 10,
                             is_training=is_training_pl, bn_decay=bn_decay, weight_decay=WEIGHT_DECAY, sn=SN, pool_t=POOL_T, freeze_bn=FREEZE_BN)
@@ -266,7 +371,10 @@ def train():
             grads = average_gradients(tower_grads)
             train_op = optimizer.apply_gradients(grads, global_step=batch)
 
-            correct = tf.equal(tf.argmax(pred, 1), tf.to_int64(labels_pl))
+            if MIXUP:
+                correct = tf.equal(tf.argmax(pred, 1), tf.argmax(labels_pl, 1))
+            else:
+                correct = tf.equal(tf.argmax(pred, 1), tf.to_int64(labels_pl))
             accuracy = tf.reduce_sum(tf.cast(correct, tf.float32)) / float(BATCH_SIZE)
             tf.summary.scalar('accuracy', accuracy)
 
@@ -317,6 +425,9 @@ def train():
                'merged': merged,
                'step': batch,
                'end_points': end_points}
+        if TF_DATA:
+            ops['train_init_op'] = train_init_op
+            ops['val_init_op'] = val_init_op
 
         best_acc = -1
         for epoch in range(MAX_EPOCH):
@@ -344,29 +455,25 @@ def train_one_epoch(sess, ops, train_writer, train_loader):
     total_seen = 0
     loss_sum = 0
 
-    for batch_idx, (inputs, targets) in enumerate(train_loader):
-        batch_data = inputs.data.numpy()
-        bsize = batch_data.shape[0]
-        batch_label = targets.data.numpy()
-        batch_data = np.transpose(batch_data, [0,2,3,4,1])
-        # batch_data shape: B*S*F*T*C
-        if SYMMETRIC_FLIP_LABELS is not None:
-            for b in range(bsize):
-                if np.random.randint(2) == 1:
-                    batch_data[b] = batch_data[b, :, :, ::-1, :]
-                    if batch_label[b] in symmetric_flip_labels.keys():
-                        batch_label[b] = symmetric_flip_labels[batch_label[b]]
-        # Swap channels
-        swap_chns = [1, 0, 2]
-        if np.random.randint(2) == 1:
-            batch_data[:,:,:,:,:] = batch_data[:,:,:,:,swap_chns]
-        
-        feed_dict = {ops['audio_pl']: batch_data,
-                     ops['labels_pl']: batch_label,
-                     ops['is_training_pl']: is_training,}
-        summary, step, _, loss_val, pred_val = sess.run([ops['merged'], ops['step'],
-            ops['train_op'], ops['loss'], ops['pred']], feed_dict=feed_dict)
+    if TF_DATA:
+        sess.run(ops['train_init_op'])
+        batches = range(len(train_loader))
+    else:
+        batches = train_loader
+    for batch_idx, batch in enumerate(batches):
+        feed_dict = {ops['is_training_pl']: is_training}
+        if not TF_DATA:
+            batch_data, batch_label = augment_batch(*batch)
+            feed_dict[ops['audio_pl']] = batch_data
+            feed_dict[ops['labels_pl']] = batch_label
+
+        # labels are fetched back, tf.data batches are only known in the graph
+        summary, step, _, loss_val, pred_val, batch_label = sess.run([ops['merged'], ops['step'],
+            ops['train_op'], ops['loss'], ops['pred'], ops['labels_pl']], feed_dict=feed_dict)
         train_writer.add_summary(summary, step)
+        bsize = batch_label.shape[0]
+        if MIXUP:
+            batch_label = np.argmax(batch_label, 1)
         pred_val = np.argmax(pred_val, 1)
         correct = np.sum(pred_val[0:bsize] == batch_label[0:bsize])
         total_correct += correct
@@ -379,6 +486,12 @@ def train_one_epoch(sess, ops, train_writer, train_loader):
             total_correct = 0
             total_seen = 0
             loss_sum = 0
+    # counters of the in-memory clip cache, only visible from here when the
+    # batches are gathered in this process
+    if TF_DATA:
+        cache_stats = train_loader.dataset.cache_stats()
+        if cache_stats is not None:
+            log_string('feature cache: %s' % cache_stats)
 
 def eval_one_epoch(sess, ops, test_writer, val_loader):
     """ ops: dict mapping from string to tf ops """
@@ -395,18 +508,27 @@ def eval_one_epoch(sess, ops, test_writer, val_loader):
     log_string(str(datetime.now()))
     log_string('---- EPOCH %03d EVALUATION ----'%(EPOCH_CNT))
 
-    for batch_idx, (inputs, targets) in enumerate(val_loader):
-        batch_data = inputs.data.numpy()
-        bsize = batch_data.shape[0]
-        batch_label = targets.data.numpy()
-        batch_data = np.transpose(batch_data, [0,2,3,4,1])
-
-        feed_dict = {ops['audio_pl']: batch_data,
-                     ops['labels_pl']: batch_label,
-                     ops['is_training_pl']: is_training}
-        summary, step, loss_val, pred_val = sess.run([ops['merged'], ops['step'],
-            ops['loss'], ops['pred']], feed_dict=feed_dict)
+    if TF_DATA:
+        sess.run(ops['val_init_op'])
+        batches = range(len(val_loader))
+    else:
+        batches = val_loader
+    for batch_idx, batch in enumerate(batches):
+        feed_dict = {ops['is_training_pl']: is_training}
+        if not TF_DATA:
+            # batch_data shape: B*S*F*T*C, ready to feed
+            batch_data, batch_label = batch
+            if MIXUP:
+                batch_label = batch_augment.one_hot(batch_label, NUM_CLASSES)
+            feed_dict[ops['audio_pl']] = batch_data
+            feed_dict[ops['labels_pl']] = batch_label
+
+        summary, step, loss_val, pred_val, batch_label = sess.run([ops['merged'], ops['step'],
+            ops['loss'], ops['pred'], ops['labels_pl']], feed_dict=feed_dict)
         test_writer.add_summary(summary, step)
+        bsize = batch_label.shape[0]
+        if MIXUP:
+            batch_label = np.argmax(batch_label, 1)
         pred_val_top5 = np.argsort(pred_val, 1)[:, ::-1][:, :5]
         pred_val_top1 = np.argmax(pred_val, 1)
         correct_top1 = np.sum(pred_val_top1[0:bsize] == batch_label[0:bsize])
@@ -416,6 +538,9 @@ def eval_one_epoch(sess, ops, test_writer, val_loader):
         total_seen += bsize
         loss_sum += loss_val
         batch_idx += 1
+    if SHARED_MEMORY and not TF_DATA:
+        # the shared-memory val workers only live during the evaluation
+        val_loader.shutdown()
 
     log_string('eval mean loss: %f' % (loss_sum / float(batch_idx)))
     log_string('eval accuracy top1 : %f'% (total_correct_top1 / float(total_seen)))
@@ -3,7 +3,6 @@
 import os
 import sys
 import numpy as np
-import torch
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR = BASE_DIR
@@ -12,70 +11,226 @@ sys.path.append(os.path.join(ROOT_DIR, 'dataloader_utils'))
 
 import spec_transforms
 import target_transforms
+import feature_store
+from samplers import RepeatSampler, BatchSampler, ShardShuffleSampler, ShardBatchSampler
+from native_loader import BatchLoader, WorkerPool
+from shm_loader import SharedMemoryLoader
 from datasets.SpecAudioDataset import SpecAudioDataset
 
-def get_loader(root, train_transform, val_transform, target_transform, 
-               batch_size=64, num_segs=8, val_samples=1, 
-               n_threads=16, train_repeat=1, training=True, val=True, test=False):
+def batch_loader(dataset, batch_size, shuffle, n_threads, drop_last, num_samples=None,
+                 shared_memory=False, window_shards=8, pool=None):
+    """
+    Loader driven by a BatchSampler: each worker gets whole lists of indices
+    and fetches the batch with SpecAudioDataset.get_batch, so there is no
+    per-sample call and no per-sample collation, see
+    native_loader.BatchLoader. Only numpy and multiprocessing are used, so
+    the TensorFlow processes do not pay for a torch import.
+    An epoch is num_samples items, passes over the dataset drawn by the
+    sampler instead of replicating the data, one pass by default.
+    The shuffled batches of a sharded store are pinned to the worker of
+    their shards, see samplers.ShardBatchSampler, so that every shard is
+    read by one worker, once per pass. Without shuffle the batches keep
+    the stored order, which the evaluation scripts rely on.
+    With shared_memory the workers write the batches into shared buffers
+    instead of sending them back, see shm_loader.SharedMemoryLoader;
+    otherwise the loader uses the workers of pool if given, see
+    native_loader.WorkerPool.
+    """
+    shard_ids = dataset.shard_ids()
+    if shard_ids is None or not shuffle:
+        sampler = RepeatSampler(len(dataset), num_samples=num_samples, shuffle=shuffle)
+        batch_sampler = BatchSampler(sampler, batch_size, drop_last)
+    else:
+        batch_sampler = ShardBatchSampler(shard_ids, batch_size, num_streams=max(1, n_threads),
+                                          num_samples=num_samples, shuffle=shuffle,
+                                          window_shards=window_shards, drop_last=drop_last)
+        # the LRU cache would evict open shards not drawn lately in favour of
+        # the shards just closed, twice the window keeps the open ones
+        dataset.feats.set_cache_shards(2 * batch_sampler.stream_window)
+    if shared_memory:
+        return SharedMemoryLoader(dataset, batch_sampler, num_workers=n_threads)
+    return BatchLoader(dataset, batch_sampler, num_workers=n_threads, pool=pool)
+
+def train_sampler(dataset, train_repeat=1, window_shards=8):
+    """
+    Sampler of an epoch of train_repeat shuffled passes over the dataset,
+    drawn by the sampler instead of replicating the data, for the loaders
+    that read in a single process (tf_dataloader.TFLoader). The clips of a
+    sharded store are drawn from window_shards open shards at a time, so
+    that every shard is read whole, once per pass.
+    """
+    num_samples = int(round(len(dataset) * train_repeat))
+    shard_ids = dataset.shard_ids()
+    if shard_ids is None:
+        return RepeatSampler(len(dataset), num_samples=num_samples, shuffle=True)
+    # open shards not drawn lately must outlive the shards just closed
+    dataset.feats.set_cache_shards(2 * window_shards)
+    return ShardShuffleSampler(shard_ids, num_samples=num_samples,
+                               window_shards=window_shards)
+
+def get_datasets(root, train_transform, val_transform, target_transform,
+                 num_segs=8, val_samples=1, training=True, val=True, test=False,
+                 seg_length=80, test_num_segs=None, channels_last=False,
+                 train_split=None, val_split=None, test_split=None,
+                 from_wav=False, cache_size=256, cache_bytes=0,
+                 cache_policy='lru', disk_cache=None, resample_sr=None,
+                 filter_half_len=10, sharded=False):
+    """
+    The train, validation and test SpecAudioDatasets of the feature stores in
+    root, None for the splits that are not requested.
+    A *_split fold list name (e.g. 'fold1_train') takes the clips of that
+    split from the shared store instead of the per-split store.
+    With from_wav the features are computed from the wav files of the fold
+    lists (fold1_train, fold1_evaluate and fold1_test unless *_split is
+    given), caching cache_size clips per worker, and the clips evicted from
+    memory in the disk_cache folder if given, analysed at resample_sr if
+    given.
+    cache_bytes > 0 keeps the hot clips of memory-mapped stores in an
+    in-memory tier of that size per worker, evicted by cache_policy.
+    With sharded the sharded copy of the training store (name_shards) is
+    read, see shard_store.py; validation and test read their stores in
+    order and keep the plain stores.
+    """
+    default_splits = {'seq_diff_train': 'fold1_train',
+                      'seq_diff_val': 'fold1_evaluate',
+                      'seq16_diff_test': 'fold1_test'}
+    def find_split_features(name, split, shards=False):
+        if from_wav:
+            split = default_splits[name] if split is None else split
+            return os.path.join(root, 'evaluation_setup', split + '.csv')
+        if split is not None:
+            name = feature_store.SHARED_STORE
+        if shards:
+            name += feature_store.SHARDED_SUFFIX
+        return feature_store.find_features(root, name)
 
+    # full-clip feature stores are segmented by the dataset, the test split
+    # is cut into twice as many segments for the multi-crop evaluation
+    if test_num_segs is None:
+        test_num_segs = 2 * num_segs
+
+    training_data, validation_data, test_data = None, None, None
     if training:
         # train dataset
         training_data = SpecAudioDataset(
-            os.path.join(root, 'seq_diff_train.npz'),
+            find_split_features('seq_diff_train', train_split, sharded),
             val_samples,
             num_segs,
             transform=train_transform,
             target_transform=target_transform,
-            mode='train')
-        if train_repeat > 1:
-            training_data.multiply_data(train_repeat)
+            mode='train',
+            seg_length=seg_length,
+            channels_last=channels_last,
+            split=train_split,
+            cache_size=cache_size,
+            cache_bytes=cache_bytes,
+            cache_policy=cache_policy,
+            disk_cache=disk_cache,
+            resample_sr=resample_sr,
+            filter_half_len=filter_half_len)
+    if val:
+        # validation dataset
+        validation_data = SpecAudioDataset(
+            find_split_features('seq_diff_val', val_split),
+            val_samples, 
+            num_segs,
+            transform=val_transform,
+            target_transform=target_transform,
+            mode='val',
+            seg_length=seg_length,
+            channels_last=channels_last,
+            split=val_split,
+            cache_size=cache_size,
+            cache_bytes=cache_bytes,
+            cache_policy=cache_policy,
+            disk_cache=disk_cache,
+            resample_sr=resample_sr,
+            filter_half_len=filter_half_len)
+    if test:
+        # test dataset
+        test_data = SpecAudioDataset(
+            find_split_features('seq16_diff_test', test_split),
+            #feature_store.find_features(root, 'seq_diff_val'),
+            val_samples, 
+            test_num_segs,
+            transform=val_transform,
+            target_transform=target_transform,
+            mode='test',
+            seg_length=seg_length,
+            channels_last=channels_last,
+            split=test_split,
+            cache_size=cache_size,
+            cache_bytes=cache_bytes,
+            cache_policy=cache_policy,
+            disk_cache=disk_cache,
+            resample_sr=resample_sr,
+            filter_half_len=filter_half_len)
+    return training_data, validation_data, test_data
+
+def get_loader(root, train_transform, val_transform, target_transform, 
+               batch_size=64, num_segs=8, val_samples=1, 
+               n_threads=16, train_repeat=1, training=True, val=True, test=False,
+               seg_length=80, test_num_segs=None, channels_last=False,
+               shared_memory=False, train_split=None, val_split=None, test_split=None,
+               from_wav=False, cache_size=256, cache_bytes=0,
+               cache_policy='lru', disk_cache=None, resample_sr=None,
+               filter_half_len=10, sharded=False, window_shards=8):
+    training_data, validation_data, test_data = get_datasets(
+        root, train_transform, val_transform, target_transform,
+        num_segs=num_segs, val_samples=val_samples,
+        training=training, val=val, test=test, seg_length=seg_length,
+        test_num_segs=test_num_segs, channels_last=channels_last,
+        train_split=train_split, val_split=val_split, test_split=test_split,
+        from_wav=from_wav, cache_size=cache_size, cache_bytes=cache_bytes,
+        cache_policy=cache_policy, disk_cache=disk_cache,
+        resample_sr=resample_sr, filter_half_len=filter_half_len,
+        sharded=sharded)
+    # the loaders share one pool of n_threads workers, see native_loader.WorkerPool
+    pool = None
+    if n_threads > 0 and not shared_memory:
+        pool = WorkerPool([d for d in (training_data, validation_data, test_data) if d is not None],
+                          n_threads)
+
+    if training:
         # train loader
-        train_loader = torch.utils.data.DataLoader(
+        train_loader = batch_loader(
             training_data,
             batch_size=batch_size,
             shuffle=True,
-            num_workers=n_threads,
-            sampler=None,
-            drop_last=True)
+            n_threads=n_threads,
+            drop_last=True,
+            num_samples=int(round(len(training_data) * train_repeat)),
+            shared_memory=shared_memory,
+            window_shards=window_shards,
+            pool=pool)
     else:
         train_loader = None
 
     if val:
-        # validation dataset
-        validation_data = SpecAudioDataset(
-            os.path.join(root, 'seq_diff_val.npz'),
-            val_samples, 
-            num_segs,
-            transform=val_transform,
-            target_transform=target_transform,
-            mode='val')
         # val loader
-        val_loader = torch.utils.data.DataLoader(
+        val_loader = batch_loader(
             validation_data,
             batch_size=batch_size // val_samples * val_samples,
             shuffle=False,
-            num_workers=n_threads,
-            drop_last=True)
+            n_threads=n_threads,
+            drop_last=True,
+            shared_memory=shared_memory,
+            window_shards=window_shards,
+            pool=pool)
     else:
         val_loader = None
 
     if test:
-        # test dataset
-        test_data = SpecAudioDataset(
-            os.path.join(root, 'seq16_diff_test.npz'),
-            #os.path.join(root, 'seq_diff_val.npz'),
-            val_samples, 
-            num_segs,
-            transform=val_transform,
-            target_transform=target_transform,
-            mode='test')
         # test loader
-        test_loader = torch.utils.data.DataLoader(
+        test_loader = batch_loader(
             test_data,
             batch_size=batch_size // val_samples * val_samples,
             shuffle=False,
-            num_workers=n_threads,
-            drop_last=True)
+            n_threads=n_threads,
+            drop_last=True,
+            shared_memory=shared_memory,
+            window_shards=window_shards,
+            pool=pool)
         return train_loader, val_loader, test_loader
     else:
         return train_loader, val_loader
@@ -101,8 +256,8 @@ if __name__ == '__main__':
     n_epochs = 1
     for epoch in range(begin_epoch, n_epochs):
         for i, (inputs, targets) in enumerate(train_loader):
-            clips = inputs.data.numpy()
-            labels = targets.data.numpy()
+            clips = inputs
+            labels = targets
             clip = clips[3]
             clip = np.transpose(clip, [1,2,3,0])
             print(labels)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Description: Batched augmentations of B*S*F*T*C spectrogram batches, applied
+# in place to the whole batch instead of sample by sample.
+import numpy as np
+
+
+def flip_label_map(symmetric_flip_labels, num_classes):
+    """
+    (num_classes,) array mapping every label to its left-right pair of the
+    symmetric_flip_labels dict, and the other labels to themselves.
+    """
+    flip_map = np.arange(num_classes)
+    for k, v in symmetric_flip_labels.items():
+        flip_map[k] = v
+    return flip_map
+
+
+def one_hot(labels, num_classes):
+    return np.eye(num_classes, dtype=np.float32)[labels]
+
+
+def time_flip(batch_data, batch_label, flip_map, p=0.5, rng=np.random):
+    """Reverses the time axis of each sample with probability p and maps its label."""
+    flip = rng.rand(len(batch_data)) < p
+    if flip.any():
+        batch_data[flip] = batch_data[flip][:, :, :, ::-1, :]
+        batch_label[flip] = flip_map[batch_label[flip]]
+    return batch_data, batch_label
+
+
+def swap_channels(batch_data, p=0.5, rng=np.random):
+    """
+    Swaps the left and right channels of the whole batch with probability p,
+    through a copy of one channel rather than of the batch.
+    """
+    if rng.rand() < p:
+        left = batch_data[..., 0].copy()
+        batch_data[..., 0] = batch_data[..., 1]
+        batch_data[..., 1] = left
+    return batch_data
+
+
+def mixup(batch_data, batch_label, alpha, num_classes, rng=np.random):
+    """
+    MixUp (Zhang et al.): every sample is blended with a random partner of
+    the batch with one lam ~ Beta(alpha, alpha) per batch.
+    Returns the mixed batch and its B*NUM_CLASSES soft one-hot labels.
+    """
+    lam = np.float32(rng.beta(alpha, alpha))
+    perm = rng.permutation(len(batch_data))
+    partner = batch_data[perm]
+    partner *= 1 - lam
+    batch_data *= lam
+    batch_data += partner
+    labels = one_hot(batch_label, num_classes)
+    labels = lam * labels + (1 - lam) * labels[perm]
+    return batch_data, labels
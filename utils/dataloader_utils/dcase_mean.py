@@ -1,10 +1,23 @@
 # -*- coding: utf-8 -*-
-def get_mean(data='dcase'):
+import numpy as np
+
+
+def load_stats(stats_file):
+    """mean and std saved by feature_store.RunningStats"""
+    stats = np.load(stats_file)
+    return stats['mean'].tolist(), stats['std'].tolist()
+
+
+def get_mean(data='dcase', stats_file=None):
+    if stats_file is not None:
+        return load_stats(stats_file)[0]
     # get from data_generation
     return [-6.0472383, -5.9414253, -5.4342027] # 2019
     #return [-6.2187624, -5.9934387, -5.5348587] # 2018
 
 
-def get_std(data='dcase'):
+def get_std(data='dcase', stats_file=None):
+    if stats_file is not None:
+        return load_stats(stats_file)[1]
     return [0.1388894, 0.11944761, 0.13605545] # 2019
     #return [0.13523865, 0.11576729, 0.12977712] # 2018
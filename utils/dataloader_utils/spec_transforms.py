@@ -17,25 +17,141 @@ class Compose(object):
     def __init__(self, transforms):
         self.transforms = transforms
 
-    def __call__(self, feat):
-        feat = np.array(feat)
+    def __call__(self, feat, copy=True):
+        """
+        feat: a single F*T*C segment or a whole B*S*F*T*C batch. With
+        copy=False the transforms may work in place on feat.
+        """
+        feat = np.array(feat) if copy else np.asarray(feat)
         for t in self.transforms:
             feat = t(feat)
         return feat
 
+    def dequantize(self, feat, scale, offset, out=None):
+        """
+        Applies the transforms to uint8 features stored with per-channel
+        scale and offset. Dequantization is fused into the first transform
+        when it supports it (ToNormalizedTensor does). out is an optional
+        float32 array to write the result to.
+        """
+        transforms = self.transforms
+        if transforms and getattr(transforms[0], "dequantize", None):
+            feat = transforms[0].dequantize(feat, scale, offset, out=out)
+            transforms = transforms[1:]
+        else:
+            feat = np.multiply(feat, np.asarray(scale, np.float32), out=out, dtype=np.float32)
+            feat += np.asarray(offset, np.float32)
+        for t in transforms:
+            feat = t(feat)
+        return feat
+
     def randomize_parameters(self):
         for t in self.transforms:
             if getattr(t, "randomize_parameters", None):
                 t.randomize_parameters()
 
+    def reseed(self, worker_id):
+        """Gives every loader worker its own stream of random parameters."""
+        for t in self.transforms:
+            if getattr(t, "reseed", None):
+                t.reseed(worker_id)
+
 class ToNormalizedTensor(object):
-    def __init__(self):
-        self.mean = get_mean()
-        self.std = get_std()
+    def __init__(self, stats_file=None):
+        """
+        stats_file: stats.npz written next to the features by
+        feature_store.RunningStats, the hard-coded DCASE 2019 values are
+        used if None.
+        """
+        self.mean = np.asarray(get_mean(stats_file=stats_file), np.float32)
+        self.std = np.asarray(get_std(stats_file=stats_file), np.float32)
 
     def __call__(self, feat):
+        """
+        Normalizes the channels (last axis) of a segment or a whole batch
+        with one broadcast operation, in place when feat is a writable
+        float32 array.
+        """
         feat = np.asarray(feat, np.float32)
-        feat[:,:,0] = (feat[:,:,0] - self.mean[0]) / self.std[0]
-        feat[:,:,1] = (feat[:,:,1] - self.mean[1]) / self.std[1]
-        feat[:,:,2] = (feat[:,:,2] - self.mean[2]) / self.std[2]
+        if not feat.flags.writeable:
+            feat = feat.copy()
+        view, mean, std = flatten_channels(feat, self.mean, self.std)
+        view -= mean
+        view /= std
         return feat
+
+    def dequantize(self, feat, scale, offset, out=None):
+        """
+        Normalized float32 features from uint8 codes in a single affine
+        step: ((codes * scale + offset) - mean) / std.
+        """
+        a = np.asarray(scale, np.float32) / self.std
+        b = (np.asarray(offset, np.float32) - self.mean) / self.std
+        if out is None:
+            out = np.empty(feat.shape, np.float32)
+        view, a, b = flatten_channels(out, a, b)
+        feat, _, _ = flatten_channels(np.ascontiguousarray(feat), self.mean, self.std)
+        np.multiply(feat, a, out=view, dtype=np.float32)
+        view += b
+        return out
+
+
+class SpecAugment(object):
+    def __init__(self, freq_masks=2, freq_width=16, time_masks=2, time_width=10,
+                 mask_value=0.0, seed=None):
+        """
+        SpecAugment (Park et al.) frequency and time masking of every
+        segment of a batch. Each segment gets freq_masks bands of up to
+        freq_width bins and time_masks bands of up to time_width frames set
+        to mask_value (0.0 is the mean once normalized, so put it after
+        ToNormalizedTensor). The bands of the whole batch are drawn at once
+        and applied with two masked copies, with no per-segment Python.
+        seed: seed of the masks, reseeded per loader worker by reseed().
+        """
+        self.freq_masks = freq_masks
+        self.freq_width = freq_width
+        self.time_masks = time_masks
+        self.time_width = time_width
+        self.mask_value = mask_value
+        self.seed = seed
+        self.rng = np.random.RandomState(seed)
+
+    def reseed(self, worker_id):
+        if self.seed is not None:
+            self.rng = np.random.RandomState([self.seed, worker_id])
+
+    def draw_masks(self, num_examples, size, num_masks, max_width):
+        """(num_examples, size) union of num_masks random bands per example."""
+        width = self.rng.randint(0, max_width + 1, (num_examples, num_masks, 1))
+        start = (self.rng.rand(num_examples, num_masks, 1) * (size - width + 1)).astype(int)
+        bins = np.arange(size)
+        return ((bins >= start) & (bins < start + width)).any(axis=1)
+
+    def __call__(self, feat):
+        """feat: a F*T*C segment or a batch of them, e.g. B*S*F*T*C."""
+        feat = np.asarray(feat, np.float32)
+        if not feat.flags.writeable or not feat.flags.c_contiguous:
+            feat = np.array(feat)
+        segs = feat.reshape((-1,) + feat.shape[-3:])
+        num_segs, num_bins, num_frames = segs.shape[:3]
+        if self.freq_masks > 0:
+            mask = self.draw_masks(num_segs, num_bins, self.freq_masks, self.freq_width)
+            np.copyto(segs, self.mask_value, where=mask[:, :, None, None])
+        if self.time_masks > 0:
+            mask = self.draw_masks(num_segs, num_frames, self.time_masks, self.time_width)
+            np.copyto(segs, self.mask_value, where=mask[:, None, :, None])
+        return feat
+
+
+def flatten_channels(feat, *stats):
+    """
+    Views a contiguous (..., T, C) array as (..., T*C) and tiles the
+    per-channel stats (shape (C,) or (..., 1, C)) to match, so that the
+    broadcast inner loop runs over T*C elements instead of C.
+    """
+    if feat.ndim < 2 or not feat.flags.c_contiguous:
+        return (feat,) + stats
+    num_frames = feat.shape[-2]
+    view = feat.reshape(feat.shape[:-2] + (-1,))
+    tiled = [np.tile(stat, num_frames).reshape(stat.shape[:-2] + (-1,)) for stat in stats]
+    return tuple([view] + tiled)
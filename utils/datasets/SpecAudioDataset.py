@@ -2,47 +2,99 @@
 # @Author: Liwen Zhang
 # @Date: 2020/02/17
 import random
-import torch
-import torch.utils.data as data
+import os
 import numpy as np
-import gc
+import pandas as pd
+import feature_store
+import feature_cache
+import wav_features
 
 
-class SpecAudioDataset(data.Dataset):
+class SpecAudioDataset(object):
 
-    def __init__(self, data_path, val_samples_per_audio, num_segs, transform=None, target_transform=None, mode='train'):
+    def __init__(self, data_path, val_samples_per_audio, num_segs, transform=None, target_transform=None, mode='train', seg_length=80, num_buffers=4, channels_last=False, split=None, cache_size=256, cache_bytes=0, cache_policy='lru', disk_cache=None, resample_sr=None, filter_half_len=10):
         r"""Simple data loader for spectrograms.
             Args:
-                data_path (str): path to spectrogram dataset folder
+                data_path (str): path to spectrogram feature store folder
+            or legacy npz file, or a fold list csv (e.g.
+            evaluation_setup/fold1_train.csv) to compute the log-Mels of its
+            wav files on the fly, see wav_features.WavFeatures
                 label_path (str): path to spectrogram label dictionary matching
             label ids to label names
-                num_segs (int): number of segments for each audio.
+                num_segs (int): number of segments for each audio, only
+            used for full-clip features, legacy sequence files keep their
+            stored segments.
                 transform (object): set of augmentation steps defined by
             Compose(). Default is None.
                 stack (bool): stack frames into a numpy.array. Default is True.
+                seg_length (int): frames per segment cut from full-clip
+            features. Default is 80.
+                num_buffers (int): number of reusable output buffers of
+            get_batch(), a batch stays valid until num_buffers more batches
+            are fetched. Default is 4.
+                channels_last (bool): output S*F*T*C numpy arrays (B*S*F*T*C
+            batches), the layout of the network placeholders, instead of
+            C*S*F*T arrays. Default is False.
+                split (str): name of a fold list of the shared store, e.g.
+            'fold1_train', the dataset is then made of the clips of its
+            index instead of the X_<mode> array. Default is None.
+                cache_size (int): clips cached per process when computing
+            the features from wav files. Default is 256.
+                cache_bytes (int): size of the in-memory tier in front of
+            the memory-mapped full-clip features of a feature store, see
+            feature_cache.TieredFeatures. Default is 0, every clip is read
+            from the store.
+                cache_policy (str): eviction policy of the in-memory caches,
+            'lru' or 'lfu'. Default is 'lru'.
+                disk_cache (str): folder of the on-disk tier when computing
+            the features from wav files. Default is None.
+                resample_sr (int): analysis sample rate when computing the
+            features from wav files, see logmel_frontend.LogMelFrontEnd.
+            Default is None, full rate.
+                filter_half_len (int): anti-aliasing filter half length of
+            the resample_sr front end. Default is 10.
         """
         print('data loader')
         self.data_path = data_path
         self.val_samples = val_samples_per_audio
         self.num_segs = num_segs
+        self.seg_length = seg_length
+        self.num_buffers = num_buffers
+        self.channels_last = channels_last
+        self.split = split
+        self.cache_size = cache_size
+        self.cache_bytes = cache_bytes
+        self.cache_policy = cache_policy
+        self.disk_cache = disk_cache
+        self.resample_sr = resample_sr
+        self.filter_half_len = filter_half_len
+        self.buffers = []
+        self.next_buffer = 0
         self.transform = transform
         self.target_transform = target_transform
         self.mode = mode
         self.class_names = []
         self.load_data()
-        print('data loading --', len(self.data))
+        print('data loading --', len(self))
 
     def __getitem__(self, index):
         """
-        With the given audio index, it fetches frames. This functions is called
-        by Pytorch DataLoader threads. Each Dataloader thread loads a single
-        batch by calling this function per instance.
-        input sequence's shape is S*F*T*C (Seg_num * Time * Freq * Channel)
-        output sequence's shape is C*S*F*T (Channel * Seg_num * Time * Freq)
+        With the given audio index, it fetches frames. The loaders fetch whole
+        batches through get_batch(), this is the per-instance access.
+        input sequence's shape is S*F*T*C (Seg_num * Time * Freq * Channel),
+        full-clip F*T*C features are cut into num_segs segments as a view
+        output sequence's shape is C*S*F*T (Channel * Seg_num * Time * Freq),
+        or S*F*T*C with channels_last
+        A list of indices, as yielded by a BatchSampler, fetches the whole
+        batch at once, see get_batch().
         """ 
-        sequence = self.data[index][0]
-        label = self.data[index][1]
-        audio_id = self.data[index][2]
+        if isinstance(index, (list, np.ndarray)):
+            return self.get_batch(index)
+        if self.indices is not None:
+            index = self.indices[index]
+        sequence = self.feats[index]
+        label = self.labels[index]
+        audio_id = self.audio_ids[index]
         
         target = {'audio_id': audio_id,
                 'label': label,
@@ -50,46 +102,201 @@ class SpecAudioDataset(data.Dataset):
         if self.target_transform:
             target = self.target_transform(target)
         
-        self.num_segs = sequence.shape[0]
+        if sequence.ndim == 3:
+            sequence = feature_store.segment_view(sequence, self.num_segs, self.seg_length)
+        else:
+            self.num_segs = sequence.shape[0]
         # normalization
-        if self.transform:
+        if self.scales is not None:
+            # uint8 codes, dequantized together with the normalization
+            scale, offset = self.scales[index], self.offsets[index]
+            if self.transform:
+                self.transform.randomize_parameters()
+                sequence = [self.transform.dequantize(seg, scale, offset) for seg in sequence]
+            else:
+                sequence = [feature_store.dequantize(seg, scale, offset) for seg in sequence]
+        elif self.transform:
             self.transform.randomize_parameters()
             sequence = [self.transform(seg) for seg in sequence]
+        else:
+            sequence = [np.asarray(seg, np.float32) for seg in sequence]
             
-        # format data to torch tensor
-        sequence = torch.from_numpy(np.stack(sequence, 0).transpose(3, 0, 1, 2))
+        sequence = np.stack(sequence, 0)
+        if self.channels_last:
+            return sequence, target
+        # channels first
+        sequence = np.ascontiguousarray(sequence.transpose(3, 0, 1, 2))
 
         return sequence, target
 
+    def segments(self):
+        """
+        N*S*F*T*C view of all segments of the dataset, a strided view on
+        the full-clip features or the stored legacy segments.
+        """
+        if getattr(self.feats, 'segment_view', None):
+            return self.feats.segment_view(self.num_segs, self.seg_length)
+        if self.feats.ndim == 4:
+            return feature_store.segment_view(self.feats, self.num_segs, self.seg_length)
+        return self.feats
+
+    def get_buffer(self, shape):
+        """Next float32 output buffer of the ring, reallocated on new shapes."""
+        if not self.buffers or self.buffers[0].shape != shape:
+            self.buffers = [np.empty(shape, np.float32) for _ in range(self.num_buffers)]
+            self.next_buffer = 0
+        buf = self.buffers[self.next_buffer]
+        self.next_buffer = (self.next_buffer + 1) % self.num_buffers
+        return buf
+
+    def get_batch(self, indices, out=None):
+        """
+        Gathers a batch into a reused output buffer (or out) and normalizes
+        it with one broadcast transform call, instead of running the
+        transform per segment. uint8 codes are gathered by fancy indexing
+        and dequantized into the buffer together with the normalization.
+        output batch's shape is B*C*S*F*T, a view on the B*S*F*T*C buffer,
+        or the contiguous B*S*F*T*C buffer itself with channels_last
+        """
+        indices = np.asarray(indices)
+        if self.indices is not None:
+            indices = self.indices[indices]
+        segs = self.segments()
+        if out is None:
+            out = self.get_buffer((len(indices),) + segs.shape[1:])
+        if self.transform:
+            self.transform.randomize_parameters()
+        if self.scales is not None:
+            # (B, C) affine maps broadcast over the B*S*F*T*C codes
+            bshape = (len(indices), 1, 1, 1, segs.shape[-1])
+            scale = self.scales[indices].reshape(bshape)
+            offset = self.offsets[indices].reshape(bshape)
+            if self.transform:
+                batch = self.transform.dequantize(segs[indices], scale, offset, out=out)
+            else:
+                batch = np.multiply(segs[indices], scale, out=out, dtype=np.float32)
+                batch += offset
+        elif isinstance(segs, np.ndarray):
+            # one gather straight into the buffer, no temporary batch;
+            # mode='clip' keeps np.take from buffering out
+            if segs.dtype == out.dtype:
+                np.take(segs, indices, axis=0, out=out, mode='clip')
+            else:
+                out[...] = np.take(segs, indices, axis=0)
+            batch = out
+            if self.transform:
+                batch = self.transform(batch, copy=False)
+        else:
+            # clip caches and wav features build their segments clip by clip
+            for i, index in enumerate(indices):
+                out[i] = segs[index]
+            batch = out
+            if self.transform:
+                batch = self.transform(batch, copy=False)
+
+        labels = self.labels[indices]
+        target = {'audio_id': self.audio_ids[indices],
+                'label': labels,
+                'label_name': self.class_names[labels]}
+        if self.target_transform:
+            target = self.target_transform(target)
+
+        if self.channels_last:
+            return batch, target
+        return batch.transpose(0, 4, 1, 2, 3), target
+
+    def cache_stats(self):
+        """Hit/miss counters of the in-memory tier of this process, None without one."""
+        cache = getattr(self.feats, 'cache', None)
+        if cache is None:
+            return None
+        return cache.stats()
+
+    def shard_ids(self):
+        """Shard of every item of a sharded store, None for the other stores."""
+        shard_of = getattr(self.feats, 'shard_of', None)
+        if shard_of is None:
+            return None
+        if self.indices is not None:
+            return shard_of(self.indices)
+        return shard_of(np.arange(len(self.feats)))
+
     def __len__(self):
         """
-        This is called by PyTorch dataloader to decide the size of the dataset.
+        This is called by the samplers to decide the size of the dataset.
         """
-        return len(self.data)
+        if self.indices is not None:
+            return len(self.indices)
+        return len(self.labels)
 
     def load_data(self):
+        """
+        Keeps the features as one array, memory-mapped for feature store
+        folders, plus compact label and id arrays. There are no per-clip
+        Python objects, so forked DataLoader workers share all pages.
+        """
         assert self.mode in ['train', 'val', 'test']
-        self.data = []
-        data_npz = np.load(self.data_path)
-        self.class_names = data_npz['class_names']
-        audio_ids = data_npz['audio_ids']
-        if self.mode == 'train':
-            num_samples = data_npz['y_train'].shape[0]
-            labels = data_npz['y_train']
-            feats = data_npz['X_train']
-        if self.mode == 'val':
-            num_samples = data_npz['y_val'].shape[0]
-            labels = data_npz['y_val']
-            feats = data_npz['X_val']
-        if self.mode == 'test':
-            num_samples = data_npz['y_test'].shape[0]
-            labels = data_npz['y_test']
-            feats = data_npz['X_test']
-        for k in range(num_samples):
-            self.data.append([feats[k], labels[k], audio_ids[k]])
-        del feats
-        gc.collect
-
-    def multiply_data(self, n_times):
-        self.data = self.data * n_times
+        if self.data_path.endswith('.csv'):
+            self.load_wavs()
+            return
+        data_npz = feature_store.load_features(self.data_path)
+        self.class_names = np.asarray(data_npz['class_names']).astype(str)
+        self.audio_ids = np.asarray(data_npz['audio_ids']).astype(str)
+        if self.split is not None:
+            feats_key, labels_key = 'X_all', 'y_all'
+        elif self.mode == 'train':
+            feats_key, labels_key = 'X_train', 'y_train'
+        elif self.mode == 'val':
+            feats_key, labels_key = 'X_val', 'y_val'
+        elif self.mode == 'test':
+            feats_key, labels_key = 'X_test', 'y_test'
+        self.labels = np.asarray(data_npz[labels_key])
+        self.feats = data_npz[feats_key]
+        # sharded arrays keep their own cache of whole shards
+        if self.cache_bytes > 0 and self.feats.ndim == 4 and not hasattr(self.feats, 'shard_of'):
+            self.feats = feature_cache.TieredFeatures(self.feats, self.cache_bytes,
+                                                      self.cache_policy)
+        # uint8 features carry their per-clip, per-channel affine map
+        if feats_key + '_scale' in data_npz:
+            self.scales = np.asarray(data_npz[feats_key + '_scale'])
+            self.offsets = np.asarray(data_npz[feats_key + '_offset'])
+        else:
+            self.scales = self.offsets = None
+        # clips of the split, selected by index from the shared store
+        if self.split is not None:
+            self.indices = np.asarray(data_npz[feature_store.index_key(self.split)])
+        else:
+            self.indices = None
 
+    def load_wavs(self):
+        """
+        Reads a tab separated fold list; the wav paths are relative to the
+        parent of its evaluation_setup folder. The class names are the
+        scene labels of all the lists of that folder, so that the train,
+        val and test lists number the scenes alike. Lists without
+        scene_label get -1 labels.
+        """
+        data_list = pd.read_csv(self.data_path, sep='\t', encoding='ASCII')
+        setup_dir = os.path.dirname(os.path.abspath(self.data_path))
+        wav_root = os.path.dirname(setup_dir)
+        self.audio_ids = np.asarray(data_list['filename'], dtype=str)
+        scene_labels = []
+        for name in sorted(os.listdir(setup_dir)):
+            if name.endswith('.csv'):
+                other_list = pd.read_csv(os.path.join(setup_dir, name), sep='\t', encoding='ASCII')
+                if 'scene_label' in other_list:
+                    scene_labels.append(other_list['scene_label'].values.astype(str))
+        if 'scene_label' in data_list:
+            self.class_names = np.unique(np.concatenate(scene_labels))
+            self.labels = np.searchsorted(self.class_names, data_list['scene_label'].values.astype(str))
+        else:
+            self.class_names = np.array([''])
+            self.labels = -np.ones(len(self.audio_ids), 'int')
+        self.feats = wav_features.WavFeatures(wav_root, self.audio_ids,
+                                              cache_size=self.cache_size,
+                                              cache_policy=self.cache_policy,
+                                              disk_cache=self.disk_cache,
+                                              resample_sr=self.resample_sr,
+                                              filter_half_len=self.filter_half_len)
+        self.scales = self.offsets = None
+        self.indices = None
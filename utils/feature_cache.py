@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# Description: In-memory tier of the feature stores, for datasets larger than
+# the memory of the node: the hot clips are kept in a size-bounded cache, the
+# others are read from the on-disk store.
+import collections
+import threading
+import numpy as np
+import feature_store
+
+
+class MemoryCache(object):
+
+    def __init__(self, max_items=None, max_bytes=None, policy='lru'):
+        r"""Size-bounded in-memory cache of numpy arrays.
+            When full, the least recently used entry ('lru') or the least
+        frequently used one, oldest first among equals ('lfu'), is evicted.
+        Hits, misses and evictions are counted. The cache is safe to share
+        between threads.
+            Args:
+                max_items (int): number of entries kept. Default is None,
+            no limit.
+                max_bytes (int): total size of the entries kept. Default is
+            None, no limit.
+                policy (str): 'lru' or 'lfu'.
+        """
+        assert policy in ['lru', 'lfu']
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.entries = collections.OrderedDict()
+        self.counts = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Returns the entry of key or None on a miss."""
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            self.counts[key] += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.entries or not self._fits(value.nbytes, 1):
+                return
+            while not self._fits(self.nbytes + value.nbytes, len(self.entries) + 1):
+                self._evict()
+            self.entries[key] = value
+            self.counts[key] = 1
+            self.nbytes += value.nbytes
+
+    def _fits(self, nbytes, num_items):
+        if self.max_items is not None and num_items > self.max_items:
+            return False
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return False
+        return True
+
+    def _evict(self):
+        if self.policy == 'lfu':
+            # entries are in recency order, min keeps the oldest of the ties
+            key = min(self.entries, key=self.counts.__getitem__)
+        else:
+            key = next(iter(self.entries))
+        self.nbytes -= self.entries.pop(key).nbytes
+        del self.counts[key]
+        self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'items': len(self.entries),
+                'bytes': self.nbytes,
+                'hit_rate': self.hits / float(lookups) if lookups else 0.0}
+
+
+class LazySegments(object):
+
+    def __init__(self, feats, num_segs, seg_length):
+        """
+        N*S*F*L*C segments of an array-like of N*F*T*C clips that is not a
+        plain ndarray, cut clip by clip with feature_store.segment_view.
+        """
+        self.feats = feats
+        self.num_segs = num_segs
+        self.seg_length = seg_length
+        n, f, _, c = feats.shape
+        self.shape = (n, num_segs, f, seg_length, c)
+        self.ndim = 5
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        return feature_store.segment_view(self.feats[index], self.num_segs, self.seg_length)
+
+
+class TieredFeatures(object):
+
+    def __init__(self, feats, max_bytes, policy='lru'):
+        r"""Read-only N*F*T*C clips of a store served through a MemoryCache.
+            A clip is copied out of the memory-mapped store array on a miss
+        and kept in the cache, so the hot clips stay in process memory within
+        max_bytes while the others are read from disk and only occupy
+        reclaimable page cache.
+            Args:
+                feats (np.memmap): N*F*T*C array of a feature store.
+                max_bytes (int): size of the in-memory tier.
+                policy (str): eviction policy, 'lru' or 'lfu'.
+        """
+        self.feats = feats
+        self.cache = MemoryCache(max_bytes=max_bytes, policy=policy)
+        self.shape = feats.shape
+        self.ndim = feats.ndim
+        self.dtype = feats.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        """F*T*C clip, or the stacked clips of an index array."""
+        if isinstance(index, (list, np.ndarray)):
+            return np.stack([self[int(i)] for i in index], 0)
+        index = int(index)
+        feat = self.cache.get(index)
+        if feat is None:
+            feat = np.array(self.feats[index])
+            feat.flags.writeable = False
+            self.cache.put(index, feat)
+        return feat
+
+    def segment_view(self, num_segs, seg_length):
+        return LazySegments(self, num_segs, seg_length)
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+# Description: On-disk feature store of memory-mappable arrays.
+#
+# A feature store is a folder holding one .npy file per array, named like the
+# keys of the former seq_diff_*.npz files (X_train.npy, y_train.npy,
+# audio_ids.npy, class_names.npy, ...). Arrays are opened with mmap_mode so
+# only the pages that are actually read are brought into memory.
+# Features are stored as full-clip N*F*T*C log-mels and cut into segments by
+# the loader with segment_view(). Legacy npz files hold N*S*F*T*C segments.
+# The per-channel normalization statistics of a store are kept next to the
+# arrays in stats.npz, see RunningStats.
+# Features may be stored as float32, float16 or uint8. uint8 features are
+# quantized per clip and channel, key_scale.npy and key_offset.npy (N*C)
+# hold the affine map back to log-mel values, see FeatureWriter.
+# The shared store seq_diff_all/ holds every clip of all the fold lists once
+# (X_all, y_all, -1 for unlabelled clips), plus index_<list>.npy with the
+# store positions of the clips of each list, e.g. index_fold1_train.npy, and
+# stats_<list>.npz for the training lists.
+# config.json records the extraction configuration of a store, see
+# save_config().
+# A feature array may also be sharded, a key/ folder of fixed-size shards read
+# whole, for storage that is only fast on sequential reads; sharded copies
+# of the stores are named like the store plus _shards, see shard_store.py.
+import argparse
+import hashlib
+import json
+import os
+import numpy as np
+import shard_store
+
+STATS_FILE = 'stats.npz'
+CONFIG_FILE = 'config.json'
+SHARED_STORE = 'seq_diff_all'
+SHARDED_SUFFIX = '_shards'
+
+
+def index_key(split):
+    """Name of the index array of a split (fold list) of the shared store."""
+    return 'index_' + split
+
+
+def stats_file(split=None):
+    return STATS_FILE if split is None else 'stats_%s.npz' % split
+
+
+class FeatureStore(object):
+
+    def __init__(self, path, mmap_mode='r'):
+        r"""Read access to a feature store folder.
+            Args:
+                path (str): path to the feature store folder.
+                mmap_mode (str): np.load mmap_mode of the arrays. Default is
+            'r', None reads the arrays into memory.
+        """
+        self.path = path
+        self.mmap_mode = mmap_mode
+
+    def __getitem__(self, key):
+        if shard_store.is_sharded(self.path, key):
+            return shard_store.ShardedFeatures(os.path.join(self.path, key))
+        file_path = os.path.join(self.path, key + '.npy')
+        if not os.path.exists(file_path):
+            raise KeyError(key)
+        return np.load(file_path, mmap_mode=self.mmap_mode)
+
+    def __contains__(self, key):
+        return (os.path.exists(os.path.join(self.path, key + '.npy'))
+                or shard_store.is_sharded(self.path, key))
+
+    def keys(self):
+        return [f[:-len('.npy')] if f.endswith('.npy') else f
+                for f in sorted(os.listdir(self.path))
+                if f.endswith('.npy') or shard_store.is_sharded(self.path, f)]
+
+
+def find_features(root, name):
+    """
+    Returns the feature store folder root/name if there is one, otherwise the
+    legacy root/name.npz file.
+    """
+    store_path = os.path.join(root, name)
+    if os.path.isdir(store_path):
+        return store_path
+    return store_path + '.npz'
+
+
+def load_features(path, mmap_mode='r'):
+    """Opens either a feature store folder or a legacy npz file."""
+    if os.path.isdir(path):
+        return FeatureStore(path, mmap_mode)
+    # legacy files store class_names as an object array
+    return np.load(path, allow_pickle=True)
+
+
+def calculate_hop_frames(total_frames, num_segs, seg_length):
+    """Hop between the starts of num_segs evenly spread segments."""
+    if num_segs < 2:
+        return 0
+    return int((total_frames - seg_length) / (num_segs - 1))
+
+
+def segment_view(feat, num_segs, seg_length):
+    """
+    Zero-copy read-only view of the (..., F, T, C) log-mel feat as
+    (..., S, F, seg_length, C) overlapping segments, laid out like the
+    segments of the legacy sequence files.
+    """
+    total_frames = feat.shape[-2]
+    if seg_length > total_frames:
+        raise ValueError('Segment length %d exceeds the %d frames of the clip'
+                         % (seg_length, total_frames))
+    hop_frames = calculate_hop_frames(total_frames, num_segs, seg_length)
+    shape = feat.shape[:-3] + (num_segs, feat.shape[-3], seg_length, feat.shape[-1])
+    strides = feat.strides[:-3] + (feat.strides[-2] * hop_frames,) + feat.strides[-3:]
+    return np.lib.stride_tricks.as_strided(feat, shape=shape, strides=strides,
+                                           writeable=False)
+
+
+def create_array(path, key, shape, dtype='float32'):
+    """
+    Creates key.npy in the store folder and returns it as a writable memmap,
+    so that items can be streamed in one at a time.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return np.lib.format.open_memmap(os.path.join(path, key + '.npy'),
+                                     mode='w+', dtype=dtype, shape=shape)
+
+
+def quantize(feat, num_levels=256):
+    """
+    Per-channel affine uint8 quantization of one (..., C) clip.
+    Returns the codes and the (C,) scale and offset such that
+    feat ~= codes * scale + offset.
+    """
+    feat = np.asarray(feat, np.float32)
+    flat = feat.reshape(-1, feat.shape[-1])
+    offset = flat.min(axis=0)
+    scale = (flat.max(axis=0) - offset) / (num_levels - 1)
+    scale[scale == 0] = 1.0
+    codes = np.rint((feat - offset) / scale)
+    np.clip(codes, 0, num_levels - 1, out=codes)
+    return codes.astype(np.uint8), scale, offset
+
+
+def dequantize(codes, scale, offset):
+    return codes * np.asarray(scale, np.float32) + np.asarray(offset, np.float32)
+
+
+class FeatureWriter(object):
+
+    def __init__(self, path, key, num_items, item_shape, dtype='float32'):
+        r"""Streams float32 clips into a store array of the given dtype.
+            Args:
+                path (str): feature store folder.
+                key (str): array name, e.g. 'X_train'.
+                num_items (int): number of clips.
+                item_shape (tuple): shape of one clip, channels last.
+                dtype (str): 'float32', 'float16' or 'uint8'. uint8 clips
+            are quantized per channel, see quantize().
+        """
+        assert dtype in ['float32', 'float16', 'uint8']
+        self.dtype = dtype
+        self.X = create_array(path, key, (num_items,) + tuple(item_shape), dtype)
+        if dtype == 'uint8':
+            self.scale = create_array(path, key + '_scale', (num_items, item_shape[-1]))
+            self.offset = create_array(path, key + '_offset', (num_items, item_shape[-1]))
+        else:
+            # maps left over from an earlier uint8 run would mark X as quantized
+            for suffix in ['_scale', '_offset']:
+                stale_path = os.path.join(path, key + suffix + '.npy')
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+
+    def __setitem__(self, index, feat):
+        if self.dtype == 'uint8':
+            self.X[index], self.scale[index], self.offset[index] = quantize(feat)
+        else:
+            self.X[index] = feat
+
+    def flush(self):
+        self.X.flush()
+        if self.dtype == 'uint8':
+            self.scale.flush()
+            self.offset.flush()
+
+
+def save_array(path, key, array):
+    if not os.path.exists(path):
+        os.makedirs(path)
+    np.save(os.path.join(path, key + '.npy'), array)
+
+
+def save_config(path, config):
+    """Writes the extraction configuration of a store to path/config.json."""
+    if not os.path.exists(path):
+        os.makedirs(path)
+    with open(os.path.join(path, CONFIG_FILE), 'w') as f:
+        json.dump(config, f, indent=2, sort_keys=True)
+
+
+def load_config(path):
+    """Extraction configuration of a store, None for stores written without one."""
+    config_path = os.path.join(path, CONFIG_FILE)
+    if not os.path.exists(config_path):
+        return None
+    with open(config_path) as f:
+        return json.load(f)
+
+
+class RunningStats(object):
+
+    def __init__(self, num_channels=3):
+        r"""Single-pass per-channel mean and standard deviation.
+            Chunks are reduced on their own and merged into the running
+        count, mean and sum of squared deviations with the parallel variant
+        of Welford's algorithm (Chan et al.), so memory only depends on the
+        chunk size and the result does not drift on long runs.
+            Args:
+                num_channels (int): size of the last (channel) axis.
+        """
+        self.count = 0
+        self.mean = np.zeros(num_channels, np.float64)
+        self.m2 = np.zeros(num_channels, np.float64)
+
+    def update(self, feat):
+        """feat: (..., C) array, e.g. one clip or a chunk of clips."""
+        feat = np.asarray(feat).reshape(-1, self.mean.shape[0])
+        count = feat.shape[0]
+        if count == 0:
+            return
+        mean = feat.mean(axis=0, dtype=np.float64)
+        m2 = np.square(feat - mean.astype(feat.dtype)).sum(axis=0, dtype=np.float64)
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + np.square(delta) * self.count * count / total
+        self.count = total
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+    def save(self, path, split=None):
+        """Writes the statistics to path/stats.npz, or stats_<split>.npz."""
+        np.savez(os.path.join(path, stats_file(split)),
+                 mean=self.mean.astype(np.float32),
+                 std=self.std.astype(np.float32),
+                 count=self.count)
+
+
+def compute_stats(path, key, chunk_size=64, split=None):
+    """
+    Statistics of array key of a feature store, read chunk_size clips at a
+    time from the memmap, so the store may be far bigger than memory.
+    With split, only the clips of index_<split> are counted.
+    """
+    store = FeatureStore(path)
+    feats = store[key]
+    if split is not None:
+        indices = np.sort(store[index_key(split)])
+    else:
+        indices = np.arange(feats.shape[0])
+    quantized = key + '_scale' in store
+    if quantized:
+        scale, offset = store[key + '_scale'], store[key + '_offset']
+    stats = RunningStats(feats.shape[-1])
+    for start in range(0, len(indices), chunk_size):
+        chunk_indices = indices[start:start + chunk_size]
+        chunk = feats[chunk_indices]
+        if quantized:
+            # (n, C) maps broadcast over the (n, ..., C) clips
+            bshape = (chunk.shape[0],) + (1,) * (chunk.ndim - 2) + (chunk.shape[-1],)
+            chunk = dequantize(chunk, scale[chunk_indices].reshape(bshape),
+                               offset[chunk_indices].reshape(bshape))
+        stats.update(chunk)
+    stats.save(path, split)
+    return stats
+
+
+def find_stats(root, name='seq_diff_train', split=None, sharded=False):
+    """
+    Path of the stats file of store root/name, or of the training split of
+    the shared store, None if there is none. With sharded, of the sharded
+    copy of the store.
+    """
+    if split is not None:
+        name = SHARED_STORE
+    if sharded:
+        name += SHARDED_SUFFIX
+    stats_path = os.path.join(root, name, stats_file(split))
+    if os.path.exists(stats_path):
+        return stats_path
+    return None
+
+
+class ClipCache(object):
+
+    def __init__(self, path, config):
+        r"""Content-addressed cache of per-clip features.
+            An entry is keyed by the sha1 of the extraction configuration and
+        of the wav file content, so a changed file or configuration simply
+        misses and is recomputed, and entries written before a crash are
+        reused on the next run.
+            Args:
+                path (str): cache folder, entries go to path/ab/abcd...npy.
+                config (dict): every extraction parameter the cached
+            features depend on.
+        """
+        self.path = path
+        self.config = json.dumps(config, sort_keys=True).encode('utf-8')
+
+    def key(self, data):
+        """data: raw bytes of the wav file."""
+        h = hashlib.sha1(self.config)
+        h.update(data)
+        return h.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.npy')
+
+    def load(self, key):
+        """Returns the cached features or None on a miss."""
+        entry_path = self._entry_path(key)
+        if not os.path.exists(entry_path):
+            return None
+        return np.load(entry_path)
+
+    def save(self, key, feat):
+        entry_path = self._entry_path(key)
+        entry_dir = os.path.dirname(entry_path)
+        if not os.path.exists(entry_dir):
+            os.makedirs(entry_dir, exist_ok=True)
+        # write then rename, a killed worker never leaves a partial entry
+        tmp_path = '%s.%d.tmp' % (entry_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, feat)
+        os.replace(tmp_path, entry_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('store', help='Feature store folder')
+    parser.add_argument('--key', default='X_train', help='Feature array to compute statistics of [default: X_train]')
+    parser.add_argument('--chunk_size', type=int, default=64, help='Clips read at a time [default: 64]')
+    parser.add_argument('--split', default=None, help='Only the clips of this split of the shared store, e.g. fold1_train [default: all clips]')
+    FLAGS = parser.parse_args()
+    stats = compute_stats(FLAGS.store, FLAGS.key, FLAGS.chunk_size, FLAGS.split)
+    print('count: %d' % stats.count)
+    print('mean: %s' % stats.mean.astype(np.float32))
+    print('std: %s' % stats.std.astype(np.float32))
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+# Description: Batched multi-channel Mel spectrogram front end.
+import fractions
+import functools
+import math
+import numpy as np
+import librosa
+from scipy import fft
+from scipy import signal
+
+
+def fft_size(n):
+    """n, or the next fast FFT size if n has a prime factor above 13 (e.g. 683)."""
+    m = n
+    for p in [2, 3, 5, 7, 11, 13]:
+        while m % p == 0:
+            m //= p
+    return n if m == 1 else fft.next_fast_len(n, real=True)
+
+
+def make_channels(s):
+    """
+    Turns a (num_samples, 2) stereo signal into the (num_samples, 3) float32
+    left, right and left-right input of the network.
+    """
+    s = np.asarray(s, np.float32)
+    return np.concatenate((s, s[:, :1] - s[:, 1:2]), axis=-1)
+
+
+class LogMelFrontEnd(object):
+
+    def __init__(self, sr=48000, n_fft=2048, hop_length=1024, n_mels=128,
+                 fmin=0.0, fmax=None, pad_mode='reflect', resample_sr=None,
+                 filter_half_len=10):
+        r"""Mel spectrograms of all channels of a signal in one FFT pass.
+            Matches librosa.feature.melspectrogram(htk=True, norm=None,
+        power=2.0, center=True) as called by sequence_generation.py. The mel
+        filterbank and the analysis window are built once here and reused
+        for every call.
+            With resample_sr, signals are first brought down to that rate by
+        a polyphase filter, and n_fft and the hop are scaled by the rate
+        ratio so that the frames keep their duration and the FFT bins their
+        spacing: the output has the same frames and mel bands, with fmax
+        capped at the new Nyquist frequency, for a fraction of the FFT work.
+        A hop that is not a whole number of samples at the new rate is
+        followed by rounding every frame start, not the hop, so the frames
+        do not drift. The power is rescaled to the levels of the full-rate
+        window; FFT sizes with a large prime factor are zero-padded.
+            Args:
+                sr (int): sample rate of the input signals.
+                n_fft (int): FFT size and window length at sr.
+                hop_length (int): hop between frames in samples at sr.
+                n_mels (int): number of mel bands.
+                fmin (float): lowest mel band edge in Hz.
+                fmax (float): highest mel band edge in Hz, sr/2 if None.
+                pad_mode (str): np.pad mode for the centered frames.
+            Default is 'reflect', the librosa default before 0.10.
+                resample_sr (int): analysis sample rate, e.g. 32000 or
+            24000. Default is None, the signals are analysed at sr.
+                filter_half_len (int): half length of the anti-aliasing
+            filter in units of max(up, down); shorter is faster and lets
+            more aliasing into the top bands. Default is 10, the
+            scipy.signal.resample_poly filter.
+        """
+        self.sr = sr
+        self.resample_sr = resample_sr
+        self.filter_half_len = filter_half_len
+        # the configuration as given, at sr
+        self.input_n_fft = n_fft
+        self.input_hop_length = hop_length
+        self.n_mels = n_mels
+        self.fmin = fmin
+        self.fmax = float(sr) / 2 if fmax is None else fmax
+        self.pad_mode = pad_mode
+        full_window = signal.get_window('hann', n_fft, fftbins=True)
+        if resample_sr is not None and resample_sr != sr:
+            g = math.gcd(int(resample_sr), int(sr))
+            self.up, self.down = int(resample_sr) // g, int(sr) // g
+            max_rate = max(self.up, self.down)
+            self.resample_filter = signal.firwin(2 * filter_half_len * max_rate + 1,
+                                                 1.0 / max_rate, window=('kaiser', 5.0))
+            n_fft = int(round(n_fft * float(resample_sr) / sr))
+            self.fmax = min(self.fmax, float(resample_sr) / 2)
+            analysis_sr = resample_sr
+        else:
+            self.up = self.down = 1
+            analysis_sr = sr
+        # hop at the analysis rate, the frame starts repeat every period
+        # frames, e.g. 0, 683, 1365 then 2048 for 1024 * 2/3
+        hop = fractions.Fraction(hop_length * self.up, self.down)
+        self.frame_hop = float(hop)
+        self.frame_period = hop.denominator
+        self.frame_step = int(hop * hop.denominator)
+        self.frame_offsets = [int(round(j * hop)) for j in range(self.frame_period)]
+        self.n_fft = n_fft
+        self.hop_length = int(round(hop))
+        self.window = signal.get_window('hann', n_fft, fftbins=True).astype(np.float32)
+        if self.up != self.down:
+            self.fft_len = fft_size(n_fft)
+            # back to the full-rate levels: power of the shorter window, and
+            # density of the bins summed by each mel band
+            gain = (full_window.sum() / self.window.sum(dtype=np.float64)) ** 2
+            gain *= (float(analysis_sr) / self.fft_len) / (float(sr) / len(full_window))
+        else:
+            self.fft_len = n_fft
+            gain = 1.0
+        # (fft_len//2+1, n_mels) so that power frames can be projected by matmul
+        mel_basis = librosa.filters.mel(
+            sr=analysis_sr, n_fft=self.fft_len, n_mels=n_mels, fmin=fmin, fmax=self.fmax,
+            htk=True, norm=None).T
+        if gain != 1.0:
+            mel_basis = mel_basis * gain
+        self.mel_basis = np.ascontiguousarray(mel_basis, np.float32)
+
+    def cache_config(self, num_frames):
+        """
+        Configuration keying the feature_store.ClipCache entries of this
+        front end, used by sequence_generation.py and wav_features alike so
+        that they share entries. The resampling keys are only set when
+        resampling, so the entries of full-rate runs keep their keys.
+        """
+        config = {'sr': self.sr,
+                  'num_mel_banks': self.n_mels,
+                  'num_fft_points': self.input_n_fft,
+                  'hop_length': self.input_hop_length,
+                  'fmin': self.fmin,
+                  'fmax': self.fmax,
+                  'pad_mode': self.pad_mode,
+                  'num_frames': num_frames}
+        if self.resample_sr:
+            config['resample_sr'] = self.resample_sr
+            config['filter_half_len'] = self.filter_half_len
+        return config
+
+    def frame_starts(self, num_padded):
+        """Frame starts in the padded signal at the analysis rate."""
+        t = np.arange(2 + int((num_padded - self.n_fft) // self.frame_hop))
+        starts = t // self.frame_period * self.frame_step
+        starts += np.asarray(self.frame_offsets)[t % self.frame_period]
+        return starts[starts <= num_padded - self.n_fft]
+
+    def num_frames(self, num_samples):
+        """Frames of a signal of num_samples samples at sr."""
+        num_samples = -(-num_samples * self.up // self.down)
+        return len(self.frame_starts(num_samples + 2 * (self.n_fft // 2)))
+
+    def resample(self, s):
+        """
+        (num_samples, C) signal at sr to the analysis rate, as a view on a
+        channel-major array. Returned as is without resample_sr.
+        """
+        if self.up == self.down:
+            return s
+        s = np.ascontiguousarray(np.asarray(s, np.float32).T)
+        s = signal.resample_poly(s, self.up, self.down, axis=-1,
+                                 window=self.resample_filter.astype(s.dtype))
+        return s.astype(np.float32, copy=False).T
+
+    def __call__(self, s):
+        """
+        s: (num_samples, C) signal at sr.
+        Returns the (F, T, C) float32 Mel power spectrogram of every channel.
+        """
+        s = np.asarray(s, np.float32)
+        if s.ndim == 1:
+            s = np.expand_dims(s, -1)
+        return self.mel(self.resample(s))
+
+    def mel(self, s):
+        """(F, T, C) Mel power spectrogram of a (num_samples, C) signal at the analysis rate."""
+        pad = self.n_fft // 2
+        s = np.pad(np.ascontiguousarray(s.T), [(0, 0), (pad, pad)], mode=self.pad_mode)
+        num_channels, num_samples = s.shape
+        num_frames = len(self.frame_starts(num_samples))
+        if self.fft_len > self.n_fft:
+            frames = np.zeros((num_channels, num_frames, self.fft_len), np.float32)
+        else:
+            frames = np.empty((num_channels, num_frames, self.n_fft), np.float32)
+        # every phase of the frame period is a (C, T/period, n_fft) view on
+        # the padded signal, windowed straight into the frames
+        for j, offset in enumerate(self.frame_offsets):
+            out = frames[:, j::self.frame_period, :self.n_fft]
+            view = np.lib.stride_tricks.as_strided(
+                s[:, offset:], shape=out.shape,
+                strides=(s.strides[0], s.strides[1] * self.frame_step, s.strides[1]),
+                writeable=False)
+            np.multiply(view, self.window, out=out)
+        spec = fft.rfft(frames, axis=-1)
+        power = np.square(spec.real)
+        power += np.square(spec.imag)
+        mel = np.matmul(power, self.mel_basis)
+        return mel.transpose(2, 1, 0)
+
+    def log_mel(self, s, num_frames=None):
+        """
+        Contiguous (F, num_frames, C) float32 log-Mel spectrogram of the
+        (num_samples, C) signal s, cropped to num_frames.
+        """
+        return self.log_compress(self(s), num_frames)
+
+    def stereo_log_mel(self, s, num_frames=None):
+        """
+        log_mel of make_channels(s) for a (num_samples, 2) stereo signal s,
+        with the left-right channel formed after resampling, which saves a
+        third of the resampling work.
+        """
+        return self.log_compress(self.mel(make_channels(self.resample(s))), num_frames)
+
+    def log_compress(self, mel, num_frames=None):
+        if num_frames is None:
+            num_frames = mel.shape[1]
+        if mel.shape[1] < num_frames:
+            raise ValueError('Got %d frames, expected %d' % (mel.shape[1], num_frames))
+        feat = np.ascontiguousarray(mel[:, :num_frames, :])
+        # log compression in place, same as np.log(X + 1e-8) on the whole array
+        feat += 1e-8
+        np.log(feat, out=feat)
+        return feat
+
+
+@functools.lru_cache(maxsize=None)
+def get_frontend(sr=48000, n_fft=2048, hop_length=1024, n_mels=128,
+                 fmin=0.0, fmax=None, pad_mode='reflect', resample_sr=None,
+                 filter_half_len=10):
+    """Shared LogMelFrontEnd per configuration, built on first use."""
+    return LogMelFrontEnd(sr, n_fft, hop_length, n_mels, fmin, fmax, pad_mode,
+                          resample_sr, filter_half_len)
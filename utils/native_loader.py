@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+# Description: Multi-worker batch loader built on multiprocessing only, the
+# drop-in replacement of the torch DataLoader for the spectrogram datasets.
+import multiprocessing
+import multiprocessing.connection
+import time
+import traceback
+import numpy as np
+
+# seconds between two checks that the workers are alive while waiting
+STATUS_CHECK_INTERVAL = 5.0
+
+
+class ResultPipes(object):
+
+    def __init__(self, ctx):
+        """
+        One result pipe per worker, read with a timeout so that the loader
+        can check on the workers. A worker that dies, even in the middle of
+        sending a batch, only breaks its own pipe, which then reads EOF
+        since the loader closes its copy of the write end.
+        """
+        self.ctx = ctx
+        self.readers = {}
+
+    def writer(self, worker_id):
+        reader, writer = self.ctx.Pipe(duplex=False)
+        self.readers[worker_id] = reader
+        return writer
+
+    def get(self, timeout):
+        """
+        Next result of any worker, None if there is none within timeout
+        seconds. Raises EOFError(worker_id) when a worker closed its pipe.
+        """
+        ready = multiprocessing.connection.wait(list(self.readers.values()), timeout)
+        if not ready:
+            return None
+        worker_id = [i for i, r in self.readers.items() if r is ready[0]][0]
+        try:
+            return ready[0].recv()
+        except (EOFError, OSError):
+            # OSError when the pipe closed in the middle of a result
+            del self.readers[worker_id]
+            raise EOFError(worker_id)
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+        self.readers = {}
+
+
+def unpin(batch):
+    """
+    (stream, indices) of a batch: batch samplers like
+    samplers.ShardBatchSampler pin a batch to the worker of its stream with
+    a (stream, indices) pair, plain lists of indices are not pinned (None).
+    """
+    if isinstance(batch, tuple):
+        return batch
+    return None, batch
+
+
+def _worker_loop(datasets, task_queue, result_pipe, worker_id, seed):
+    np.random.seed(seed + worker_id)
+    for dataset in datasets:
+        if getattr(dataset.transform, 'reseed', None):
+            dataset.transform.reseed(worker_id)
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        dataset_id, batch_idx, indices = task
+        try:
+            batch, target = datasets[dataset_id].get_batch(indices)
+            result_pipe.send((batch_idx, batch, target, None))
+        except Exception:
+            result_pipe.send((batch_idx, None, None, traceback.format_exc()))
+
+
+class WorkerPool(object):
+
+    def __init__(self, datasets, num_workers, seed=0, timeout=0):
+        r"""Forked workers building the batches of several datasets.
+            The train, validation and test loaders of a run share one pool
+        (see dataloader.get_loader), so that num_workers processes are
+        resident instead of num_workers per loader, and start() can fork
+        them before a TensorFlow session exists. The loaders of a pool are
+        iterated one at a time.
+            Args:
+                datasets (list): the SpecAudioDatasets, shared with the
+            workers by fork, so they are given before start().
+                num_workers (int): number of worker processes.
+                seed (int): base numpy seed of the workers.
+                timeout (float): seconds to wait for a batch before raising.
+            Default is 0, wait as long as the workers are alive; a worker
+            that dies (e.g. killed on out of memory) raises in any case.
+        """
+        self.datasets = list(datasets)
+        self.num_workers = num_workers
+        self.seed = seed
+        self.timeout = timeout
+        self.workers = []
+        self.outstanding = 0
+
+    def dataset_id(self, dataset):
+        for i, d in enumerate(self.datasets):
+            if d is dataset:
+                return i
+        raise ValueError('The dataset is not served by this worker pool')
+
+    def start(self):
+        ctx = multiprocessing.get_context('fork')
+        self.task_queues = [ctx.SimpleQueue() for _ in range(self.num_workers)]
+        self.result_pipes = ResultPipes(ctx)
+        for i in range(self.num_workers):
+            writer = self.result_pipes.writer(i)
+            w = ctx.Process(target=_worker_loop,
+                            args=(self.datasets, self.task_queues[i], writer, i, self.seed))
+            w.daemon = True
+            w.start()
+            # the worker holds the only write end, a dead worker reads EOF
+            writer.close()
+            self.workers.append(w)
+
+    def shutdown(self):
+        if not self.workers:
+            return
+        for task_queue in self.task_queues:
+            task_queue.put(None)
+        # workers still sending batches of an abandoned epoch only get to
+        # their sentinel once the results are taken off the queue
+        deadline = time.time() + 2 * STATUS_CHECK_INTERVAL
+        while any(w.is_alive() for w in self.workers) and time.time() < deadline:
+            try:
+                self.result_pipes.get(timeout=0.1)
+            except EOFError:
+                pass
+        for w in self.workers:
+            # stuck in the dataset code
+            if w.is_alive():
+                w.terminate()
+            w.join()
+        self.result_pipes.close()
+        self.workers = []
+        self.outstanding = 0
+
+    def __del__(self):
+        if self.workers:
+            self.shutdown()
+
+    def check_workers(self, worker_id=None):
+        """Raises if a worker, or worker worker_id, has exited."""
+        for i, w in enumerate(self.workers):
+            if i == worker_id:
+                w.join()
+            if not w.is_alive():
+                raise RuntimeError('Loader worker %d (pid %d) exited unexpectedly with code %s'
+                                   % (i, w.pid, w.exitcode))
+
+    def put(self, worker, dataset_id, batch_idx, indices):
+        self.task_queues[worker % self.num_workers].put((dataset_id, batch_idx, list(indices)))
+        self.outstanding += 1
+
+    def get_result(self):
+        start = time.time()
+        while True:
+            result = None
+            try:
+                result = self.result_pipes.get(
+                    timeout=min(STATUS_CHECK_INTERVAL, self.timeout or STATUS_CHECK_INTERVAL))
+            except EOFError as e:
+                self.check_workers(e.args[0])
+            if result is not None:
+                break
+            self.check_workers()
+            if self.timeout and time.time() - start > self.timeout:
+                raise RuntimeError('Loader timed out after %.0f s waiting for a batch'
+                                   % self.timeout)
+        batch_idx, batch, target, error = result
+        self.outstanding -= 1
+        if error is not None:
+            raise RuntimeError('Loader worker failed on batch %d:\n%s' % (batch_idx, error))
+        return batch_idx, batch, target
+
+
+class BatchLoader(object):
+
+    def __init__(self, dataset, batch_sampler, num_workers=0, prefetch=2, seed=0,
+                 timeout=0, pool=None):
+        r"""Ordered batches of a SpecAudioDataset, built by forked workers.
+            Each worker fetches whole batches with SpecAudioDataset.get_batch
+        and sends them back pickled, so a yielded batch is an array of its
+        own, like the batches of a torch DataLoader. The batches go to the
+        workers in turn, or to the worker of their stream when the batch
+        sampler pins them, see unpin(). Without workers the
+        batches are built in the calling process and are views on the ring
+        buffers of the dataset, valid until num_buffers more batches are
+        fetched.
+            Args:
+                dataset (SpecAudioDataset): the dataset, shared with the
+            workers by fork.
+                batch_sampler (iterable): yields the list of indices of every
+            batch, e.g. a samplers.BatchSampler, or (stream, indices) pairs,
+            e.g. a samplers.ShardBatchSampler.
+                num_workers (int): number of worker processes, 0 loads in
+            the calling process.
+                prefetch (int): batches in flight per worker.
+                seed (int): base numpy seed of the workers.
+                timeout (float): seconds to wait for a batch before raising.
+            Default is 0, wait as long as the workers are alive; a worker
+            that dies (e.g. killed on out of memory) raises in any case.
+                pool (WorkerPool): workers shared with other loaders, whose
+            datasets include dataset. Default is None, the loader forks its
+            own num_workers workers.
+        """
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+        self.prefetch = prefetch
+        if pool is None:
+            pool = WorkerPool([dataset], num_workers, seed, timeout)
+        self.pool = pool
+        self.dataset_id = pool.dataset_id(dataset)
+        self.num_workers = pool.num_workers
+
+    @property
+    def workers(self):
+        return self.pool.workers
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def start(self):
+        self.pool.start()
+
+    def shutdown(self):
+        """Stops the workers, of all the loaders of the pool; they are forked again on next use."""
+        self.pool.shutdown()
+
+    def __iter__(self):
+        if self.num_workers == 0:
+            for batch in self.batch_sampler:
+                yield self.dataset.get_batch(unpin(batch)[1])
+            return
+        pool = self.pool
+        if not pool.workers:
+            pool.start()
+        # results of an epoch that was left early
+        while pool.outstanding > 0:
+            pool.get_result()
+        batches = enumerate(self.batch_sampler)
+        max_outstanding = self.num_workers * self.prefetch
+        done = {}
+        next_idx = 0
+        exhausted = False
+        while True:
+            while pool.outstanding < max_outstanding and not exhausted:
+                task = next(batches, None)
+                if task is None:
+                    exhausted = True
+                    break
+                stream, indices = unpin(task[1])
+                worker = task[0] if stream is None else stream
+                pool.put(worker, self.dataset_id, task[0], indices)
+            if next_idx not in done:
+                if pool.outstanding == 0:
+                    break
+                batch_idx, batch, target = pool.get_result()
+                done[batch_idx] = (batch, target)
+                continue
+            batch, target = done.pop(next_idx)
+            next_idx += 1
+            yield batch, target
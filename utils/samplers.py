@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# Description: Index samplers for the spectrogram data loaders.
+import numpy as np
+
+
+class RepeatSampler(object):
+
+    def __init__(self, num_items, num_samples=None, shuffle=True, seed=None):
+        r"""Indices over a virtual epoch of any length.
+            The epoch is made of consecutive passes over the dataset, each
+        one a fresh permutation (or 0..num_items-1 without shuffle), and the
+        last pass is cut at num_samples. Only one pass worth of indices is
+        held at a time, so longer epochs cost no memory and the dataset
+        storage is never replicated.
+            Args:
+                num_items (int): size of the underlying dataset.
+                num_samples (int): length of the virtual epoch. Default is
+            num_items.
+                shuffle (bool): permute the items of every pass.
+                seed (int): seed of the permutations. Default is None.
+        """
+        self.num_items = num_items
+        self.num_samples = num_items if num_samples is None else num_samples
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed)
+
+    def __iter__(self):
+        remaining = self.num_samples
+        while remaining > 0:
+            if self.shuffle:
+                order = self.rng.permutation(self.num_items)
+            else:
+                order = np.arange(self.num_items)
+            order = order[:remaining]
+            remaining -= len(order)
+            for index in order:
+                yield int(index)
+
+    def __len__(self):
+        return self.num_samples
+
+
+class BatchSampler(object):
+
+    def __init__(self, sampler, batch_size, drop_last):
+        r"""Groups the indices of a sampler into lists of batch_size indices.
+            Same batches as torch.utils.data.BatchSampler.
+            Args:
+                sampler (iterable): yields the item indices, e.g. a
+            RepeatSampler.
+                batch_size (int): size of the batches.
+                drop_last (bool): drop the last batch if it is smaller than
+            batch_size.
+        """
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        batch = []
+        for index in self.sampler:
+            batch.append(index)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch and not self.drop_last:
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.sampler) // self.batch_size
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+
+class ShardShuffleSampler(object):
+
+    def __init__(self, shard_ids, num_samples=None, shuffle=True, window_shards=8, seed=None):
+        r"""Indices that read a sharded store shard by shard.
+            Every pass visits the shards in a fresh random order and keeps a
+        window of window_shards of them open: the next index is drawn at
+        random among the remaining items of the open shards, and a shard is
+        closed, and the next one opened, once all its items are drawn. So at
+        most window_shards shards are in use at any time and every shard is
+        read once per pass, the window being the shuffle buffer. Without
+        shuffle the items are drawn in order. The passes are chained and
+        cut at num_samples like by RepeatSampler.
+            Args:
+                shard_ids (np.ndarray): shard number of every item, see
+            shard_store.ShardedFeatures.shard_of().
+                num_samples (int): length of the virtual epoch. Default is
+            the number of items.
+                shuffle (bool): shuffle the shards and the items.
+                window_shards (int): number of open shards.
+                seed (int): seed of the shuffling. Default is None.
+        """
+        shard_ids = np.asarray(shard_ids)
+        self.num_items = len(shard_ids)
+        self.num_samples = self.num_items if num_samples is None else num_samples
+        self.shuffle = shuffle
+        self.window_shards = window_shards
+        self.rng = np.random.RandomState(seed)
+        # shard of every item, numbered 0..num_shards-1, and items of every shard
+        _, self.item_shards = np.unique(shard_ids, return_inverse=True)
+        order = np.argsort(self.item_shards, kind='stable')
+        bounds = np.cumsum(np.bincount(self.item_shards))[:-1]
+        self.shard_items = np.split(order, bounds)
+
+    def one_pass(self, shards=None, window_shards=None):
+        """
+        Indices of one pass over shards, all of them by default, visited in
+        a fresh random order with shuffle.
+        """
+        if shards is None:
+            shards = np.arange(len(self.shard_items))
+        if window_shards is None:
+            window_shards = self.window_shards
+        if not self.shuffle:
+            for shard in shards:
+                for index in self.shard_items[shard]:
+                    yield int(index)
+            return
+        shard_order = iter(self.rng.permutation(shards))
+        remaining = {}
+        pool = []
+
+        def open_shard():
+            shard = next(shard_order, None)
+            if shard is not None:
+                remaining[shard] = len(self.shard_items[shard])
+                pool.extend(self.shard_items[shard].tolist())
+
+        for _ in range(window_shards):
+            open_shard()
+        while pool:
+            j = self.rng.randint(len(pool))
+            index = pool[j]
+            pool[j] = pool[-1]
+            pool.pop()
+            yield index
+            shard = self.item_shards[index]
+            remaining[shard] -= 1
+            if remaining[shard] == 0:
+                del remaining[shard]
+                open_shard()
+
+    def __iter__(self):
+        remaining = self.num_samples
+        while remaining > 0:
+            for index in self.one_pass():
+                yield index
+                remaining -= 1
+                if remaining == 0:
+                    return
+
+    def __len__(self):
+        return self.num_samples
+
+
+class ShardBatchSampler(ShardShuffleSampler):
+
+    def __init__(self, shard_ids, batch_size, num_streams=1, num_samples=None, shuffle=True,
+                 window_shards=8, drop_last=True, seed=None):
+        r"""Batches of a sharded store, each one pinned to a loader worker.
+            Every pass deals the shards, in a fresh random order with
+        shuffle, to num_streams streams, one per loader worker. A stream
+        draws the items of its own shards like ShardShuffleSampler, from a
+        window of stream_window of them, and groups them into batches; the
+        streams take turns. The batches are yielded as (stream, indices)
+        pairs and native_loader.BatchLoader sends every batch of a stream
+        to the same worker, so each shard is read by a single worker, once
+        per pass, and a worker only caches its own stream_window shards.
+        The items left at the end of the streams, fewer than batch_size
+        per stream, make the last batches of the pass, which are not
+        pinned (stream None). The passes are chained and cut at
+        num_samples.
+            Args:
+                shard_ids (np.ndarray): shard number of every item, see
+            shard_store.ShardedFeatures.shard_of().
+                batch_size (int): size of the batches.
+                num_streams (int): number of streams, the number of loader
+            workers. Default is 1.
+                num_samples (int): length of the virtual epoch. Default is
+            the number of items.
+                shuffle (bool): shuffle the shards and the items.
+                window_shards (int): number of open shards over all the
+            streams.
+                drop_last (bool): drop the last batch of a pass if it is
+            smaller than batch_size.
+                seed (int): seed of the shuffling. Default is None.
+        """
+        super(ShardBatchSampler, self).__init__(shard_ids, num_samples, shuffle,
+                                                window_shards, seed)
+        self.batch_size = batch_size
+        self.num_streams = num_streams
+        self.drop_last = drop_last
+        self.stream_window = max(1, -(-window_shards // num_streams))
+
+    def pass_batches(self):
+        """(stream, indices) batches of one pass."""
+        num_shards = len(self.shard_items)
+        order = self.rng.permutation(num_shards) if self.shuffle else np.arange(num_shards)
+        streams = [self.one_pass(order[s::self.num_streams], self.stream_window)
+                   for s in range(self.num_streams)]
+        active = list(range(self.num_streams))
+        leftover = []
+        while active:
+            for s in list(active):
+                batch = [int(index) for _, index in zip(range(self.batch_size), streams[s])]
+                if len(batch) == self.batch_size:
+                    yield s, batch
+                else:
+                    leftover.extend(batch)
+                    active.remove(s)
+        for i in range(0, len(leftover), self.batch_size):
+            batch = leftover[i:i + self.batch_size]
+            if len(batch) == self.batch_size or not self.drop_last:
+                yield None, batch
+
+    def __iter__(self):
+        remaining = len(self)
+        while remaining > 0:
+            for stream, batch in self.pass_batches():
+                yield stream, batch
+                remaining -= 1
+                if remaining == 0:
+                    return
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
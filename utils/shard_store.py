@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+# Description: Sharded feature arrays, for disks and network filesystems that
+# are only fast on sequential reads.
+#
+# A sharded array replaces key.npy of a feature store by a key/ folder of
+# fixed-size shards of contiguous clips, key/00000.npy, key/00001.npy, ...,
+# plus key/index.json with the number of clips, the clip shape, the dtype
+# and the first clip and clip count of every shard. A shard is always read
+# whole, in one sequential read, and kept in a small cache while its clips
+# are used; samplers.ShardShuffleSampler draws the clips so that only a few
+# shards are in use at a time.
+# Shards may be compressed, key/00000.bin, ...: chunks of chunk_clips clips,
+# byte-shuffled (the k-th bytes of all the values first, so the exponent
+# bytes of the log-mels sit together) and compressed with zlib, or lz4 and
+# zstd when the lz4 and zstandard packages are installed. The chunk sizes
+# are in the index, and the shards are decompressed by the loader workers.
+import argparse
+import json
+import os
+import shutil
+import zlib
+import numpy as np
+import feature_store
+import feature_cache
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+INDEX_FILE = 'index.json'
+DEFAULT_LEVELS = {'zlib': 1, 'lz4': 0, 'zstd': 1}
+
+
+def available_codecs():
+    codecs = ['zlib']
+    if lz4 is not None:
+        codecs.append('lz4')
+    if zstandard is not None:
+        codecs.append('zstd')
+    return codecs
+
+
+def compress(data, codec, level):
+    if codec == 'zlib':
+        return zlib.compress(data, level)
+    if codec == 'lz4':
+        return lz4.frame.compress(data, compression_level=level)
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    raise ValueError('Unknown codec %s' % codec)
+
+
+def decompress(data, codec):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'lz4':
+        return lz4.frame.decompress(data)
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError('Unknown codec %s' % codec)
+
+
+def encode_chunk(chunk, codec, level, byte_shuffle=True):
+    """Compressed bytes of an array, byte-shuffled first if byte_shuffle."""
+    data = np.ascontiguousarray(chunk).view(np.uint8).reshape(-1, chunk.dtype.itemsize)
+    if byte_shuffle:
+        data = np.ascontiguousarray(data.T)
+    return compress(data.tobytes(), codec, level)
+
+
+def decode_chunk(data, codec, out, byte_shuffle=True):
+    """Decompresses the bytes of encode_chunk() into the array out."""
+    raw = np.frombuffer(decompress(data, codec), np.uint8)
+    out_bytes = out.reshape(-1).view(np.uint8).reshape(-1, out.dtype.itemsize)
+    if byte_shuffle:
+        out_bytes[...] = raw.reshape(out.dtype.itemsize, -1).T
+    else:
+        out_bytes[...] = raw.reshape(out_bytes.shape)
+
+
+def is_sharded(path, key):
+    return os.path.isfile(os.path.join(path, key, INDEX_FILE))
+
+
+class ShardWriter(object):
+
+    def __init__(self, path, key, num_items, item_shape, dtype='float32', shard_size=256,
+                 codec=None, level=None, chunk_clips=8, byte_shuffle=True):
+        r"""Streams float32 clips, in order, into the shards of path/key/.
+            Args:
+                path (str): feature store folder.
+                key (str): array name, e.g. 'X_train'.
+                num_items (int): number of clips.
+                item_shape (tuple): shape of one clip, channels last.
+                dtype (str): 'float32', 'float16' or 'uint8'. The affine
+            maps of uint8 clips go to the usual key_scale.npy and
+            key_offset.npy arrays of the store, see feature_store.quantize().
+                shard_size (int): clips per shard, the last shard may be
+            shorter. Default is 256, about 180 MB of float32 10 s clips.
+                codec (str): None writes .npy shards, 'zlib', 'lz4' or
+            'zstd' compressed .bin shards, see available_codecs().
+                level (int): compression level. Default is the fast level
+            of the codec, DEFAULT_LEVELS.
+                chunk_clips (int): clips per compressed chunk.
+                byte_shuffle (bool): byte-shuffle the chunks before
+            compressing them.
+        """
+        assert dtype in ['float32', 'float16', 'uint8']
+        if codec is not None and codec not in available_codecs():
+            raise ValueError('Codec %s is not available, use one of %s'
+                             % (codec, available_codecs()))
+        self.codec = codec
+        self.level = DEFAULT_LEVELS.get(codec) if level is None else level
+        self.chunk_clips = chunk_clips
+        self.byte_shuffle = byte_shuffle
+        self.path = path
+        self.key = key
+        self.num_items = num_items
+        self.item_shape = tuple(item_shape)
+        self.dtype = dtype
+        self.shard_size = shard_size
+        self.shard_path = os.path.join(path, key)
+        if os.path.exists(self.shard_path):
+            shutil.rmtree(self.shard_path)
+        os.makedirs(self.shard_path)
+        self.shards = []
+        self.buffer = np.empty((shard_size,) + self.item_shape, dtype)
+        self.count = 0
+        self.next_index = 0
+        if dtype == 'uint8':
+            self.scale = np.empty((num_items, item_shape[-1]), np.float32)
+            self.offset = np.empty((num_items, item_shape[-1]), np.float32)
+
+    def __setitem__(self, index, feat):
+        if index != self.next_index:
+            raise ValueError('Shards are written in order, got clip %d, expected %d'
+                             % (index, self.next_index))
+        if self.dtype == 'uint8':
+            codes, self.scale[index], self.offset[index] = feature_store.quantize(feat)
+            self.append(codes)
+        else:
+            self.append(feat)
+
+    def append(self, item):
+        """Adds the next clip as it is stored, e.g. uint8 codes of another store."""
+        self.buffer[self.count] = item
+        self.count += 1
+        self.next_index += 1
+        if self.count == self.shard_size:
+            self.write_shard()
+
+    def write_shard(self):
+        shard = {'start': self.next_index - self.count, 'count': self.count}
+        if self.codec is None:
+            shard['file'] = '%05d.npy' % len(self.shards)
+            np.save(os.path.join(self.shard_path, shard['file']), self.buffer[:self.count])
+        else:
+            shard['file'] = '%05d.bin' % len(self.shards)
+            chunks = [encode_chunk(self.buffer[i:min(i + self.chunk_clips, self.count)],
+                                   self.codec, self.level, self.byte_shuffle)
+                      for i in range(0, self.count, self.chunk_clips)]
+            with open(os.path.join(self.shard_path, shard['file']), 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            shard['chunk_bytes'] = [len(chunk) for chunk in chunks]
+        self.shards.append(shard)
+        self.count = 0
+
+    def flush(self):
+        """Writes the last shard and the index, once all the clips are in."""
+        if self.count:
+            self.write_shard()
+        index = {'num_items': self.next_index, 'item_shape': list(self.item_shape),
+                 'dtype': self.dtype, 'shard_size': self.shard_size,
+                 'codec': self.codec, 'shards': self.shards}
+        if self.codec is not None:
+            index.update({'level': self.level, 'chunk_clips': self.chunk_clips,
+                          'byte_shuffle': self.byte_shuffle})
+        with open(os.path.join(self.shard_path, INDEX_FILE), 'w') as f:
+            json.dump(index, f, indent=2)
+        if self.dtype == 'uint8':
+            feature_store.save_array(self.path, self.key + '_scale', self.scale[:self.next_index])
+            feature_store.save_array(self.path, self.key + '_offset', self.offset[:self.next_index])
+
+
+class ShardedFeatures(object):
+
+    def __init__(self, path, cache_shards=2):
+        r"""Read-only N*F*T*C array over the shards of a sharded array.
+            Any clip can be read, its shard is then loaded whole and kept in
+        an LRU cache of cache_shards shards, so clips drawn shard by shard
+        (see samplers.ShardShuffleSampler) read every shard once. Every
+        loader worker holds its own cache, and decompresses the compressed
+        shards it reads: samplers.ShardBatchSampler pins the batches of a
+        shard to one worker so that the workers do not read the same shards.
+            Args:
+                path (str): the key/ folder of the sharded array.
+                cache_shards (int): shards kept in memory. Default is 2.
+        """
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.shards = index['shards']
+        self.starts = np.array([s['start'] for s in self.shards], 'int')
+        self.counts = np.array([s['count'] for s in self.shards], 'int')
+        self.shape = (index['num_items'],) + tuple(index['item_shape'])
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(index['dtype'])
+        self.codec = index.get('codec')
+        self.chunk_clips = index.get('chunk_clips')
+        self.byte_shuffle = index.get('byte_shuffle', True)
+        self.cache = feature_cache.MemoryCache(max_items=cache_shards)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def set_cache_shards(self, cache_shards):
+        self.cache.max_items = cache_shards
+
+    def shard_of(self, indices):
+        """Shard number of every clip index."""
+        return np.searchsorted(self.starts, indices, side='right') - 1
+
+    def read_shard(self, shard):
+        """Reads and decompresses shard shard, bypassing the cache."""
+        file_path = os.path.join(self.path, self.shards[shard]['file'])
+        if self.codec is None:
+            return np.load(file_path)
+        with open(file_path, 'rb') as f:
+            raw = memoryview(f.read())
+        data = np.empty((self.shards[shard]['count'],) + self.shape[1:], self.dtype)
+        pos = 0
+        for i, nbytes in enumerate(self.shards[shard]['chunk_bytes']):
+            start = i * self.chunk_clips
+            decode_chunk(raw[pos:pos + nbytes], self.codec,
+                         data[start:start + self.chunk_clips], self.byte_shuffle)
+            pos += nbytes
+        return data
+
+    def load_shard(self, shard):
+        data = self.cache.get(shard)
+        if data is None:
+            data = self.read_shard(shard)
+            data.flags.writeable = False
+            self.cache.put(shard, data)
+        return data
+
+    def __getitem__(self, index):
+        """F*T*C clip, or the stacked clips of an index array."""
+        if isinstance(index, (list, np.ndarray)):
+            return np.stack([self[int(i)] for i in index], 0)
+        index = int(index)
+        shard = int(self.shard_of(index))
+        return self.load_shard(shard)[index - self.starts[shard]]
+
+    def segment_view(self, num_segs, seg_length):
+        return feature_cache.LazySegments(self, num_segs, seg_length)
+
+
+def convert_store(path, output, key, shard_size=256, seed=0, codec=None,
+                  level=None, chunk_clips=8, byte_shuffle=True):
+    """
+    Writes a sharded copy of the feature store path to output, with the
+    clips of key in a random order (seed None keeps the store order) so that
+    a shard holds a mix of scenes and recordings. Every per-clip array is
+    permuted the same way and index_<list> arrays point to the new
+    positions, sorted so that the clips of a list are read shard by shard
+    in the dataset order too; the other files are copied. codec and the
+    following arguments are those of ShardWriter.
+    """
+    store = feature_store.FeatureStore(path)
+    X = store[key]
+    num_items = len(X)
+    if seed is None:
+        order = np.arange(num_items)
+    else:
+        order = np.random.RandomState(seed).permutation(num_items)
+    quantized = key + '_scale' in store
+    dtype = 'uint8' if quantized else str(X.dtype)
+    writer = ShardWriter(output, key, num_items, X.shape[1:], dtype, shard_size,
+                         codec, level, chunk_clips, byte_shuffle)
+    for j in order:
+        # uint8 codes are copied as they are, not quantized again
+        writer.append(X[j])
+    if quantized:
+        writer.scale = np.asarray(store[key + '_scale'])[order]
+        writer.offset = np.asarray(store[key + '_offset'])[order]
+    writer.flush()
+
+    # new position of every store clip, for the index arrays
+    positions = np.empty(num_items, 'int')
+    positions[order] = np.arange(num_items)
+    for name in store.keys():
+        if name == key or name in [key + '_scale', key + '_offset']:
+            continue
+        array = np.asarray(store[name])
+        if name.startswith('index_'):
+            array = np.sort(positions[array])
+        elif array.ndim > 0 and len(array) == num_items and name != 'class_names':
+            array = array[order]
+        feature_store.save_array(output, name, array)
+    for name in os.listdir(path):
+        if name.endswith('.npz') or name == feature_store.CONFIG_FILE:
+            shutil.copy(os.path.join(path, name), os.path.join(output, name))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('store', help='Feature store folder, e.g. ../data/dcase2019/Task1a/dev/seq_diff_train')
+    parser.add_argument('--key', default=None, help='Feature array to shard [default: the X_* array of the store]')
+    parser.add_argument('--output', default=None, help='Sharded store folder [default: STORE_shards]')
+    parser.add_argument('--shard_size', type=int, default=256, help='Clips per shard [default: 256]')
+    parser.add_argument('--codec', default=None, help='Shard compression, zlib, or lz4 or zstd if installed [default: None, uncompressed]')
+    parser.add_argument('--level', type=int, default=None, help='Compression level [default: fast level of the codec]')
+    parser.add_argument('--chunk_clips', type=int, default=8, help='Clips per compressed chunk [default: 8]')
+    parser.add_argument('--no_byte_shuffle', action='store_true', help='Compress the chunks without byte shuffling')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the clip order of the shards, -1 keeps the store order [default: 0]')
+    FLAGS = parser.parse_args()
+    store_path = FLAGS.store.rstrip('/')
+    key = FLAGS.key
+    if key is None:
+        key = [k for k in feature_store.FeatureStore(store_path).keys()
+               if k.startswith('X_') and not k.endswith(('_scale', '_offset'))][0]
+    output = FLAGS.output or store_path + feature_store.SHARDED_SUFFIX
+    convert_store(store_path, output, key, FLAGS.shard_size,
+                  None if FLAGS.seed < 0 else FLAGS.seed, FLAGS.codec,
+                  FLAGS.level, FLAGS.chunk_clips, not FLAGS.no_byte_shuffle)
+    print('%s/%s: %d shards' % (output, key, len(ShardedFeatures(os.path.join(output, key)).shards)))
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Description: Batch loader whose workers write finished batches into a ring
+# of shared-memory buffers, so batches reach the training loop without being
+# pickled or copied.
+import multiprocessing
+import time
+import traceback
+import numpy as np
+from native_loader import STATUS_CHECK_INTERVAL, ResultPipes, unpin
+
+
+def _worker_loop(dataset, slots, task_queue, result_pipe, worker_id, seed):
+    np.random.seed(seed + worker_id)
+    if getattr(dataset.transform, 'reseed', None):
+        dataset.transform.reseed(worker_id)
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        batch_idx, slot, indices = task
+        try:
+            out = slots[slot][:len(indices)]
+            batch, target = dataset.get_batch(indices, out=out)
+            if not np.shares_memory(batch, out):
+                # a transform that returned a new array
+                out[...] = batch if dataset.channels_last else batch.transpose(0, 2, 3, 4, 1)
+            result_pipe.send((batch_idx, slot, len(indices), target, None))
+        except Exception:
+            result_pipe.send((batch_idx, slot, 0, None, traceback.format_exc()))
+
+
+class SharedMemoryLoader(object):
+
+    def __init__(self, dataset, batch_sampler, num_workers=4, num_slots=None, seed=0):
+        r"""Ordered batches of a SpecAudioDataset built by forked workers.
+            Each worker fetches whole batches with SpecAudioDataset.get_batch
+        straight into a slot of a shared ring of B*S*F*T*C float32 buffers;
+        only the batch number, the slot and the targets go through the
+        result queue. A yielded batch is a view on its slot and stays valid
+        until the next batch is requested, then the slot is handed out again.
+        The batches go to the workers like in native_loader.BatchLoader.
+            Args:
+                dataset (SpecAudioDataset): the dataset, shared with the
+            workers by fork.
+                batch_sampler (iterable): yields the list of indices of every
+            batch, e.g. a BatchSampler, or (stream, indices) pairs, e.g. a
+            ShardBatchSampler.
+                num_workers (int): number of worker processes.
+                num_slots (int): number of shared buffers, i.e. batches in
+            flight plus the one held by the consumer. Default is
+            num_workers + 2.
+                seed (int): base numpy seed of the workers.
+        """
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+        self.num_workers = max(1, num_workers)
+        self.num_slots = self.num_workers + 2 if num_slots is None else num_slots
+        self.seed = seed
+        self.workers = []
+        self.outstanding = 0
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def start(self):
+        ctx = multiprocessing.get_context('fork')
+        batch_size = self.batch_sampler.batch_size
+        shape = (self.num_slots, batch_size) + self.dataset.segments().shape[1:]
+        buf = ctx.RawArray('f', int(np.prod(shape)))
+        self.slots = np.frombuffer(buf, np.float32).reshape(shape)
+        self.task_queues = [ctx.SimpleQueue() for _ in range(self.num_workers)]
+        self.result_pipes = ResultPipes(ctx)
+        for i in range(self.num_workers):
+            writer = self.result_pipes.writer(i)
+            w = ctx.Process(target=_worker_loop,
+                            args=(self.dataset, self.slots, self.task_queues[i],
+                                  writer, i, self.seed))
+            w.daemon = True
+            w.start()
+            writer.close()
+            self.workers.append(w)
+
+    def shutdown(self):
+        if not self.workers:
+            return
+        for task_queue in self.task_queues:
+            task_queue.put(None)
+        # take the results of an abandoned epoch so that the workers exit
+        deadline = time.time() + 2 * STATUS_CHECK_INTERVAL
+        while any(w.is_alive() for w in self.workers) and time.time() < deadline:
+            try:
+                self.result_pipes.get(timeout=0.1)
+            except EOFError:
+                pass
+        for w in self.workers:
+            if w.is_alive():
+                w.terminate()
+            w.join()
+        self.result_pipes.close()
+        self.workers = []
+        self.outstanding = 0
+
+    def __del__(self):
+        if self.workers:
+            self.shutdown()
+
+    def _get_result(self):
+        while True:
+            try:
+                result = self.result_pipes.get(timeout=STATUS_CHECK_INTERVAL)
+            except EOFError as e:
+                self.workers[e.args[0]].join()
+                result = None
+            if result is not None:
+                break
+            for i, w in enumerate(self.workers):
+                if not w.is_alive():
+                    raise RuntimeError('Loader worker %d (pid %d) exited unexpectedly with code %s'
+                                       % (i, w.pid, w.exitcode))
+        batch_idx, slot, size, target, error = result
+        self.outstanding -= 1
+        if error is not None:
+            raise RuntimeError('Loader worker failed on batch %d:\n%s' % (batch_idx, error))
+        return batch_idx, slot, size, target
+
+    def __iter__(self):
+        if not self.workers:
+            self.start()
+        # results of an epoch that was left early
+        while self.outstanding > 0:
+            self._get_result()
+        batches = enumerate(self.batch_sampler)
+        free_slots = list(range(self.num_slots))
+        done = {}
+        next_idx = 0
+        held_slot = None
+        exhausted = False
+        while True:
+            if held_slot is not None:
+                free_slots.append(held_slot)
+                held_slot = None
+            while free_slots and not exhausted:
+                task = next(batches, None)
+                if task is None:
+                    exhausted = True
+                    break
+                stream, indices = unpin(task[1])
+                worker = task[0] if stream is None else stream
+                self.task_queues[worker % self.num_workers].put(
+                    (task[0], free_slots.pop(), list(indices)))
+                self.outstanding += 1
+            if next_idx not in done:
+                if self.outstanding == 0:
+                    break
+                batch_idx, slot, size, target = self._get_result()
+                done[batch_idx] = (slot, size, target)
+                continue
+            slot, size, target = done.pop(next_idx)
+            next_idx += 1
+            held_slot = slot
+            batch = self.slots[slot][:size]
+            if self.dataset.channels_last:
+                yield batch, target
+            else:
+                yield batch.transpose(0, 4, 1, 2, 3), target
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Description: Graph versions of the batched augmentations of
+# dataloader_utils/batch_augment.py, for the tf.data pipeline.
+import numpy as np
+import tensorflow as tf
+
+
+def time_flip(batch_data, batch_label, flip_map, p=0.5):
+    """
+    Reverses the time axis of each B*S*F*T*C sample with probability p and
+    maps its label with the flip_map of batch_augment.flip_label_map.
+    """
+    flip = tf.random_uniform(tf.shape(batch_label)[:1]) < p
+    batch_data = tf.where(flip, tf.reverse(batch_data, axis=[3]), batch_data)
+    flip_map = tf.constant(np.asarray(flip_map), dtype=batch_label.dtype)
+    batch_label = tf.where(flip, tf.gather(flip_map, batch_label), batch_label)
+    return batch_data, batch_label
+
+
+def swap_channels(batch_data, p=0.5):
+    """Swaps the left and right channels of the whole batch with probability p."""
+    return tf.cond(tf.random_uniform([]) < p,
+                   lambda: tf.gather(batch_data, [1, 0, 2], axis=4),
+                   lambda: batch_data)
+
+
+def mixup(batch_data, batch_label, alpha, num_classes):
+    """
+    MixUp with one lam ~ Beta(alpha, alpha) per batch, drawn as a ratio of
+    gamma variates. Returns the mixed batch and its B*NUM_CLASSES soft
+    one-hot labels.
+    """
+    g1 = tf.random_gamma([], alpha)
+    g2 = tf.random_gamma([], alpha)
+    lam = g1 / (g1 + g2)
+    perm = tf.random_shuffle(tf.range(tf.shape(batch_data)[0]))
+    batch_data = lam * batch_data + (1 - lam) * tf.gather(batch_data, perm)
+    labels = tf.one_hot(batch_label, num_classes)
+    labels = lam * labels + (1 - lam) * tf.gather(labels, perm)
+    return batch_data, labels
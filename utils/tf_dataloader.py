@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# Description: tf.data input pipeline over the feature stores, so that batches
+# are read, normalized, augmented and prefetched while the graph runs instead
+# of being pushed through feed_dict.
+import os
+import sys
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BASE_DIR)
+import numpy as np
+import tensorflow as tf
+import dataloader
+
+
+class TFLoader(object):
+
+    def __init__(self, dataset, batch_size, shuffle=False, num_samples=None,
+                 map_fn=None, num_parallel_calls=4, prefetch=2, seed=None,
+                 sampler=None):
+        r"""tf.data batches of a channels_last SpecAudioDataset.
+            The pipeline only draws indices in the graph; each batch is then
+        gathered and normalized by SpecAudioDataset.get_batch inside a
+        py_func, so the store is read the same way as by dataloader.get_loader.
+        The pipeline is built by build() in the graph of the caller.
+            Args:
+                dataset (SpecAudioDataset): channels_last dataset.
+                batch_size (int): batch size, the last partial batch is
+            dropped so that the batch dimension is static.
+                shuffle (bool): reshuffle the items on every pass.
+                num_samples (int): length of an epoch, passes over the
+            dataset are chained like by samplers.RepeatSampler. Default is
+            len(dataset).
+                map_fn (function): (batch, labels) -> (batch, labels) graph
+            function applied to every batch, e.g. augmentation.
+                num_parallel_calls (int): batches gathered in parallel.
+                prefetch (int): batches prepared ahead of the consumer.
+                seed (int): shuffle seed. Default is None.
+                sampler (iterable): yields the indices of an epoch in place
+            of the shuffled range, e.g. a samplers.ShardShuffleSampler.
+            Default is None.
+        """
+        assert dataset.channels_last
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_samples = len(dataset) if num_samples is None else num_samples
+        if sampler is not None:
+            self.num_samples = len(sampler)
+        self.sampler = sampler
+        self.map_fn = map_fn
+        self.num_parallel_calls = num_parallel_calls
+        self.prefetch = prefetch
+        self.seed = seed
+        self.sample_shape = dataset.segments().shape[1:]
+
+    def __len__(self):
+        return self.num_samples // self.batch_size
+
+    def fetch(self, indices):
+        # a fresh output per call, parallel calls must not share the ring
+        # buffers of the dataset and the tensor may alias the array
+        batch = np.empty((len(indices),) + self.sample_shape, np.float32)
+        batch, labels = self.dataset.get_batch(indices, out=batch)
+        return batch, np.asarray(labels, np.int32)
+
+    def load(self, indices):
+        batch, labels = tf.py_func(self.fetch, [indices], [tf.float32, tf.int32])
+        batch.set_shape((self.batch_size,) + self.sample_shape)
+        labels.set_shape((self.batch_size,))
+        return batch, labels
+
+    def build(self):
+        """Returns the tf.data.Dataset of one epoch of (batch, labels)."""
+        num_items = len(self.dataset)
+        if self.sampler is not None:
+            # the generator is run again by every initialization
+            ds = tf.data.Dataset.from_generator(lambda: iter(self.sampler), tf.int64,
+                                                tf.TensorShape([]))
+        else:
+            ds = tf.data.Dataset.range(num_items)
+            if self.shuffle:
+                ds = ds.shuffle(num_items, seed=self.seed, reshuffle_each_iteration=True)
+            ds = ds.repeat().take(self.num_samples)
+        ds = ds.batch(self.batch_size, drop_remainder=True)
+        ds = ds.map(self.load, num_parallel_calls=self.num_parallel_calls)
+        if self.map_fn is not None:
+            ds = ds.map(self.map_fn, num_parallel_calls=self.num_parallel_calls)
+        return ds.prefetch(self.prefetch)
+
+
+def get_loader(root, train_transform, val_transform, target_transform,
+               batch_size=64, num_segs=8, val_samples=1,
+               n_threads=16, train_repeat=1, training=True, val=True, test=False,
+               seg_length=80, test_num_segs=None, train_map_fn=None,
+               eval_map_fn=None, prefetch=2, train_split=None, val_split=None,
+               test_split=None, from_wav=False, cache_size=256, cache_bytes=0,
+               cache_policy='lru', disk_cache=None, resample_sr=None,
+               filter_half_len=10, sharded=False, window_shards=8):
+    """
+    Same splits and arguments as dataloader.get_loader, with TFLoaders in
+    place of the batch loaders. train_map_fn is applied to the training
+    batches, eval_map_fn to the validation and test batches.
+    """
+    training_data, validation_data, test_data = dataloader.get_datasets(
+        root, train_transform, val_transform, target_transform,
+        num_segs=num_segs, val_samples=val_samples,
+        training=training, val=val, test=test, seg_length=seg_length,
+        test_num_segs=test_num_segs, channels_last=True,
+        train_split=train_split, val_split=val_split, test_split=test_split,
+        from_wav=from_wav, cache_size=cache_size, cache_bytes=cache_bytes,
+        cache_policy=cache_policy, disk_cache=disk_cache,
+        resample_sr=resample_sr, filter_half_len=filter_half_len,
+        sharded=sharded)
+
+    train_loader, val_loader, test_loader = None, None, None
+    if training:
+        sampler = None
+        if training_data.shard_ids() is not None:
+            sampler = dataloader.train_sampler(training_data, train_repeat, window_shards)
+        train_loader = TFLoader(
+            training_data, batch_size, shuffle=True,
+            num_samples=int(round(len(training_data) * train_repeat)),
+            map_fn=train_map_fn, num_parallel_calls=n_threads, prefetch=prefetch,
+            sampler=sampler)
+    if val:
+        val_loader = TFLoader(
+            validation_data, batch_size // val_samples * val_samples,
+            map_fn=eval_map_fn, num_parallel_calls=n_threads, prefetch=prefetch)
+    if test:
+        test_loader = TFLoader(
+            test_data, batch_size // val_samples * val_samples,
+            map_fn=eval_map_fn, num_parallel_calls=n_threads, prefetch=prefetch)
+        return train_loader, val_loader, test_loader
+    return train_loader, val_loader
+
+
+def fcn_crops(batch_data, batch_label, num_segs, fcn):
+    """
+    Graph version of the multi-crop inputs of evaluate.py for a batch of one
+    clip: (1, S, F, T, C) to (fcn, num_segs, F, T, C) crops over the segment
+    axis, each with its time-reversed twin. Other fcn values pass through.
+    """
+    def flip(x):
+        return tf.reverse(x, axis=[1])
+    if fcn == 2:
+        crops = [batch_data, flip(batch_data)]
+    elif fcn == 5:
+        crops = [batch_data[:, ::2], batch_data[:, 1::2],
+                 batch_data[:, :num_segs], batch_data[:, -num_segs:],
+                 batch_data[:, num_segs//2:num_segs//2+num_segs]]
+    elif fcn == 10:
+        crops = []
+        for crop in [batch_data[:, ::2], batch_data[:, 1::2],
+                     batch_data[:, :num_segs], batch_data[:, -num_segs:],
+                     batch_data[:, num_segs//2:num_segs//2+num_segs]]:
+            crops += [crop, flip(crop)]
+    else:
+        return batch_data, batch_label
+    return tf.concat(crops, axis=0), tf.tile(batch_label, [len(crops)])
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# Description: In-graph log-Mel front end, so that the network can be fed raw
+# waveforms instead of the sequences produced by sequence_generation.py.
+import os
+import sys
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(BASE_DIR)
+sys.path.append(os.path.join(BASE_DIR, 'dataloader_utils'))
+import numpy as np
+import tensorflow as tf
+import logmel_frontend
+import feature_store
+from dcase_mean import get_mean, get_std
+
+
+def waveform_placeholder(batch_size, num_samples, num_audio_channels=2):
+    return tf.placeholder(tf.float32, shape=(batch_size, num_samples, num_audio_channels))
+
+
+def logmel(waveforms, sr=48000, n_fft=2048, hop_length=1024, n_mels=128,
+           fmin=0.0, fmax=None, num_frames=None):
+    """
+    Input:
+        waveforms: (batch_size, num_samples, 2) float32 stereo signals
+    Output:
+        (batch_size, n_mels, num_frames, 3) float32 log-Mel spectrograms of
+        the left, right and left-right channels, numerically aligned with
+        logmel_frontend.LogMelFrontEnd (reflect-padded centered frames,
+        periodic hann window, htk mel filterbank without norm).
+    """
+    frontend = logmel_frontend.get_frontend(sr=sr, n_fft=n_fft,
+                                            hop_length=hop_length,
+                                            n_mels=n_mels, fmin=fmin, fmax=fmax)
+    with tf.name_scope('logmel'):
+        s = tf.concat([waveforms, waveforms[:, :, :1] - waveforms[:, :, 1:2]], axis=-1)
+        s = tf.transpose(s, [0, 2, 1])
+        pad = n_fft // 2
+        s = tf.pad(s, [[0, 0], [0, 0], [pad, pad]], mode='REFLECT')
+        # (B, C, T, n_fft//2+1)
+        spec = tf.signal.stft(s, frame_length=n_fft, frame_step=hop_length,
+                              fft_length=n_fft, window_fn=tf.signal.hann_window,
+                              pad_end=False)
+        power = tf.square(tf.math.real(spec)) + tf.square(tf.math.imag(spec))
+        mel = tf.tensordot(power, tf.constant(frontend.mel_basis), axes=1)
+        if num_frames is not None:
+            mel = mel[:, :, :num_frames, :]
+        mel = tf.math.log(mel + 1e-8)
+        return tf.transpose(mel, [0, 3, 2, 1])
+
+
+def segment(feat, num_segs, seg_length):
+    """
+    Cuts (batch_size, F, T, C) features into (batch_size, S, F, seg_length, C)
+    segments, same hops as feature_store.segment_view.
+    """
+    total_frames = feat.get_shape()[2].value
+    hop_frames = feature_store.calculate_hop_frames(total_frames, num_segs, seg_length)
+    segs = [feat[:, :, (i*hop_frames):(i*hop_frames+seg_length), :] for i in range(num_segs)]
+    return tf.stack(segs, axis=1)
+
+
+def logmel_segments(waveforms, num_segs, seg_length, num_frames=None,
+                    normalize=True, mean=None, std=None, **frontend_kwargs):
+    """
+    Raw stereo waveforms to the (batch_size, S, F, seg_length, 3) network input
+    of placeholder_inputs, normalized like spec_transforms.ToNormalizedTensor.
+    """
+    feat = logmel(waveforms, num_frames=num_frames, **frontend_kwargs)
+    if normalize:
+        mean = np.asarray(get_mean() if mean is None else mean, np.float32)
+        std = np.asarray(get_std() if std is None else std, np.float32)
+        feat = (feat - tf.constant(mean)) / tf.constant(std)
+    return segment(feat, num_segs, seg_length)
+
+
+if __name__=='__main__':
+    sr = 48000
+    s = np.random.uniform(-0.5, 0.5, (2, 10 * sr, 2)).astype(np.float32)
+    with tf.Graph().as_default():
+        waveforms_pl = waveform_placeholder(2, 10 * sr)
+        feat = logmel(waveforms_pl, sr=sr)
+        with tf.Session() as sess:
+            feat_val = sess.run(feat, feed_dict={waveforms_pl: s})
+    frontend = logmel_frontend.get_frontend(sr=sr)
+    ref = np.log(frontend(logmel_frontend.make_channels(s[0])) + 1e-8)
+    print(feat_val.shape, np.abs(feat_val[0] - ref).max())
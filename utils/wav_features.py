@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Description: Log-Mel features computed from the wav files on first access,
+# for training without a pre-extracted feature store.
+import io
+import math
+import os
+import numpy as np
+import soundfile as sound
+import logmel_frontend
+import feature_store
+import feature_cache
+
+
+class WavFeatures(object):
+
+    def __init__(self, root, wav_paths, cache_size=256, num_frames=None,
+                 sr=48000, n_fft=2048, hop_length=1024, n_mels=128,
+                 fmin=0.0, fmax=None, cache_policy='lru', disk_cache=None,
+                 resample_sr=None, filter_half_len=10):
+        r"""Read-only N*F*T*C array of the log-Mels of a list of wav files.
+            Clips are decoded and go through logmel_frontend on first
+        access, exactly like in sequence_generation.py, and are kept in a
+        feature_cache.MemoryCache, so later epochs over a subset that fits the
+        cache are cheap. Every loader worker holds its own cache. With a
+        disk_cache folder, the clips evicted from memory are read back from
+        a feature_store.ClipCache instead of being recomputed.
+            Args:
+                root (str): folder the wav paths are relative to.
+                wav_paths (list): wav files, one clip per item.
+                cache_size (int): clips kept in memory per process, about
+            0.7 MB each for 10 s stereo clips. Default is 256.
+                num_frames (int): frames kept per clip. Default is
+            ceil(num_samples / hop_length) of the first clip, the
+            sequence_generation.py setting.
+                sr, n_fft, hop_length, n_mels, fmin, fmax: log-Mel
+            configuration, see logmel_frontend.LogMelFrontEnd.
+                cache_policy (str): eviction policy of the memory cache,
+            'lru' or 'lfu'. Default is 'lru'.
+                disk_cache (str): ClipCache folder, the feature_cache folder
+            of sequence_generation.py shares its entries. Default is None,
+            no disk tier.
+                resample_sr (int): analysis sample rate of the reduced-rate
+            front end, see logmel_frontend.LogMelFrontEnd. Default is None.
+                filter_half_len (int): anti-aliasing filter half length of
+            the reduced-rate front end. Default is 10.
+        """
+        self.root = root
+        self.wav_paths = list(wav_paths)
+        self.cache = feature_cache.MemoryCache(max_items=cache_size, policy=cache_policy)
+        self.frontend = logmel_frontend.get_frontend(sr=sr, n_fft=n_fft,
+                                                     hop_length=hop_length,
+                                                     n_mels=n_mels,
+                                                     fmin=fmin, fmax=fmax,
+                                                     resample_sr=resample_sr,
+                                                     filter_half_len=filter_half_len)
+        if num_frames is None:
+            info = sound.info(os.path.join(root, self.wav_paths[0]))
+            num_frames = int(math.ceil(float(info.frames) / hop_length))
+        self.num_frames = num_frames
+        self.disk_cache = None
+        if disk_cache:
+            self.disk_cache = feature_store.ClipCache(disk_cache,
+                                                      self.frontend.cache_config(num_frames))
+        self.shape = (len(self.wav_paths), n_mels, num_frames, 3)
+        self.ndim = 4
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def compute(self, index):
+        with open(os.path.join(self.root, self.wav_paths[index]), 'rb') as f:
+            data = f.read()
+        if self.disk_cache is not None:
+            key = self.disk_cache.key(data)
+            feat = self.disk_cache.load(key)
+            if feat is not None:
+                feat.flags.writeable = False
+                return feat
+        s, fs = sound.read(io.BytesIO(data), dtype='float32')
+        if fs != self.frontend.sr:
+            raise ValueError('%s is sampled at %d Hz, expected %d'
+                             % (self.wav_paths[index], fs, self.frontend.sr))
+        feat = self.frontend.stereo_log_mel(s, self.num_frames)
+        if self.disk_cache is not None:
+            self.disk_cache.save(key, feat)
+        feat.flags.writeable = False
+        return feat
+
+    def __getitem__(self, index):
+        """F*T*C log-Mel of one clip, or the stacked clips of an index array."""
+        if isinstance(index, (list, np.ndarray)):
+            return np.stack([self[int(i)] for i in index], 0)
+        index = int(index)
+        feat = self.cache.get(index)
+        if feat is None:
+            feat = self.compute(index)
+            self.cache.put(index, feat)
+        return feat
+
+    def segment_view(self, num_segs, seg_length):
+        return feature_cache.LazySegments(self, num_segs, seg_length)